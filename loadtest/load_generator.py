@@ -0,0 +1,170 @@
+'''
+Synthetic load for the bot: posts message_new callbacks to /api at a steady rate and measures, through
+vk_emulator.py, how long each one took from the callback to the message with the rendered attachment.
+
+The bot must be talking to the emulator (VK_API_BASE_URL), and the emulator must run with --code-in-caption:
+every expression gets a unique TeX comment, and a delivery is matched to its callback by finding that tag in
+the caption. Replies without the tag (LaTeX errors, rate limit notices) are matched to the oldest unanswered
+callback of the same chat. Each callback comes from one of --users user ids, so per-user rate limits in
+CONFIG.env apply; raise RATE_LIMIT_USER for load tests, or use many users.
+
+    python load_generator.py --api http://localhost:9157/api --emulator http://localhost:8080 --rate 5 --duration 60
+'''
+from concurrent.futures import ThreadPoolExecutor
+import statistics
+import threading
+import argparse
+import requests
+import random
+import time
+import json
+import sys
+import os
+
+DEFAULT_CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'renderer_src', 'bench_corpus.json')
+if not os.path.exists(DEFAULT_CORPUS):
+    DEFAULT_CORPUS = '/bench_corpus.json'  # where the loadtest image keeps it
+GROUP_CHAT_BASE = 2000000000  # VK peer ids of group chats start here
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values)-1, int(round(fraction*(len(values)-1))))]
+
+def summarize(values):
+    return {'count': len(values), 'mean': statistics.mean(values) if values else None,
+            'p50': percentile(values, 0.5), 'p95': percentile(values, 0.95), 'p99': percentile(values, 0.99), 'max': max(values, default=None)}
+
+class LoadGenerator:
+    def __init__(self, api_url, emulator_url, secret, expressions, users, group_fraction):
+        self.api_url = api_url
+        self.emulator_url = emulator_url.rstrip('/')
+        self.secret = secret
+        self.expressions = expressions
+        self.users = users
+        self.group_fraction = group_fraction
+        self.http = requests.Session()
+        self.lock = threading.Lock()
+        self.pending = {}  # tag -> sent callback
+        self.done = []
+        self.ack_errors = 0
+        self.sent_cursor = 0
+        self.counter = 0
+
+    def make_event(self):
+        with self.lock:
+            self.counter += 1
+            number = self.counter
+        sender = 100000000 + random.randrange(self.users)
+        peer = GROUP_CHAT_BASE + 1 + sender % 10 if random.random() < self.group_fraction else sender
+        tag = f'loadtest-{os.getpid()}-{number}'
+        text = random.choice(self.expressions)+'\n%'+tag
+        if peer != sender:
+            text = '[club1|@inlatexbot] '+text  # how VK passes on a mention of the bot in a group chat
+        event = {
+            'type': 'message_new', 'group_id': 1, 'event_id': tag, 'secret': self.secret,
+            'object': {'message': {'id': number, 'date': int(time.time()), 'from_id': sender, 'peer_id': peer,
+                                   'conversation_message_id': number, 'text': text}},
+        }
+        return tag, sender, peer, event
+
+    def send_one(self):
+        tag, sender, peer, event = self.make_event()
+        record = {'tag': tag, 'peer_id': peer, 'sent': time.time()}
+        with self.lock:
+            self.pending[tag] = record
+        try:
+            response = self.http.post(self.api_url, json=event, timeout=30)
+            record['acked'] = time.time()
+            record['ack_ok'] = response.status_code == 200 and response.text == 'ok'
+        except requests.RequestException:
+            record['ack_ok'] = False
+        if not record['ack_ok']:
+            with self.lock:
+                self.ack_errors += 1
+                self.pending.pop(tag, None)
+
+    def poll_deliveries(self):
+        '''Match messages the bot sent to the emulator since the last poll to pending callbacks.'''
+        data = self.http.get(self.emulator_url+'/sent', params={'after': self.sent_cursor}, timeout=30).json()
+        self.sent_cursor += len(data['messages'])
+        with self.lock:
+            for message in data['messages']:
+                record = next((r for tag, r in self.pending.items() if tag in message['message']), None)
+                if record is None:
+                    waiting = [r for r in self.pending.values() if r['peer_id'] == message['peer_id']]
+                    record = min(waiting, key=lambda r: r['sent'], default=None)
+                if record is None:
+                    continue
+                record['delivered'] = message['time']
+                record['outcome'] = 'rendered' if message['attachment'] else 'reply'
+                record['reply'] = message['message'][:200] if not message['attachment'] else None
+                self.done.append(self.pending.pop(record['tag']))
+
+    def run(self, rate, duration, drain):
+        pool = ThreadPoolExecutor(max(4, int(rate*4)))
+        started = time.time()
+        next_send = started
+        while time.time() < started+duration:
+            pool.submit(self.send_one)
+            next_send += random.expovariate(rate)  # Poisson arrivals, like independent users
+            while time.time() < next_send:
+                self.poll_deliveries()
+                time.sleep(min(0.2, max(0, next_send-time.time())))
+        pool.shutdown(wait=True)
+        deadline = time.time()+drain
+        while self.pending and time.time() < deadline:
+            self.poll_deliveries()
+            time.sleep(0.2)
+        return time.time()-started
+
+    def report(self, wall):
+        rendered = [r for r in self.done if r['outcome'] == 'rendered']
+        replies = [r for r in self.done if r['outcome'] == 'reply']
+        acked = [r for r in self.done+list(self.pending.values()) if 'acked' in r]
+        return {
+            'sent': self.counter,
+            'ack_errors': self.ack_errors,
+            'ack_seconds': summarize([r['acked']-r['sent'] for r in acked]),
+            'rendered': len(rendered),
+            'other_replies': len(replies),
+            'reply_samples': sorted({r['reply'] for r in replies})[:10],
+            'undelivered': len(self.pending),
+            'end_to_end_seconds': summarize([r['delivered']-r['sent'] for r in rendered]),
+            'wall_seconds': wall,
+            'delivered_per_second': len(rendered)/wall if wall else None,
+        }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Post synthetic message_new callbacks and measure end-to-end render latency.')
+    parser.add_argument('--api', default='http://localhost:9157/api', help="the bot's Callback API URL")
+    parser.add_argument('--emulator', default='http://localhost:8080', help='base URL of vk_emulator.py')
+    parser.add_argument('--secret', default=os.getenv('VK_SECRET', ''), help='the VK_SECRET the bot expects')
+    parser.add_argument('--rate', type=float, default=2, help='callbacks per second, on average')
+    parser.add_argument('--duration', type=float, default=60, help='seconds to keep sending')
+    parser.add_argument('--drain', type=float, default=60, help='seconds to wait for outstanding deliveries afterwards')
+    parser.add_argument('--users', type=int, default=1000, help='how many distinct senders to spread the callbacks over')
+    parser.add_argument('--group-fraction', type=float, default=0.2, help='share of callbacks that come from group chats')
+    parser.add_argument('--corpus', default=DEFAULT_CORPUS, help='expressions to send; the benchmark corpus, without its error cases')
+    parser.add_argument('--output', help='write the JSON report here instead of to stdout')
+    args = parser.parse_args(argv)
+
+    with open(args.corpus) as f:
+        corpus = json.load(f)
+    expressions = [case['expression'] for case in corpus['cases'] if not case.get('expect_error') and not case.get('preambles')]
+    generator = LoadGenerator(args.api, args.emulator, args.secret, expressions, args.users, args.group_fraction)
+    wall = generator.run(args.rate, args.duration, args.drain)
+    report = dict(generator.report(wall), rate=args.rate, duration=args.duration, users=args.users)
+    e2e = report['end_to_end_seconds']
+    print(f"sent {report['sent']}, rendered {report['rendered']}, other replies {report['other_replies']}, undelivered {report['undelivered']}"
+          + (f", end to end p50 {e2e['p50']:.2f} s, p95 {e2e['p95']:.2f} s, p99 {e2e['p99']:.2f} s" if e2e['count'] else ''), file=sys.stderr)
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
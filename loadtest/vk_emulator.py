@@ -0,0 +1,149 @@
+'''
+Offline stand-in for the parts of the VK API the bot uses, for load tests.
+
+Point the bot at it with VK_API_BASE_URL=http://<host>:<port>/ in CONFIG.env; both the web app and the renderers
+then send every API call here. Upload servers handed out by the photos/docs methods point back at this server.
+Everything is kept in memory and lost on restart.
+
+Every messages.send is recorded with the time it arrived; GET /sent?after=<n> returns the messages recorded
+after the first n, which is how load_generator.py finds out when a render was delivered.
+'''
+from flask import Flask, request, jsonify
+import threading
+import argparse
+import json
+import time
+import re
+
+app = Flask(__name__)
+lock = threading.Lock()
+state = {
+    'storage': {},  # (user_id, key) -> value
+    'sent': [],  # recorded messages.send calls
+    'uploads': 0,
+    'latency': 0,  # seconds added to every API call
+    'defaults': {},  # storage values every user starts with
+}
+
+def next_id():
+    with lock:
+        state['uploads'] += 1
+        return state['uploads']
+
+def storage_get(values):
+    user_id = int(values.get('user_id', 0))
+    keys = values.get('keys') or values.get('key') or ''
+    if isinstance(keys, str):
+        keys = [i for i in keys.split(',') if i]
+    with lock:
+        return [{'key': key, 'value': state['storage'].get((user_id, key), state['defaults'].get(key, ''))} for key in keys]
+
+def storage_set(values):
+    with lock:
+        state['storage'][(int(values.get('user_id', 0)), values['key'])] = values.get('value', '')
+    return 1
+
+def users_get(values):
+    users = []
+    for spec in str(values.get('user_ids', '')).split(','):
+        spec = spec.strip()
+        if not spec:
+            continue
+        user_id = int(spec) if spec.lstrip('-').isdigit() else int(spec[2:]) if re.fullmatch(r'id\d+', spec) else abs(hash(spec)) % 10**8
+        users.append({'id': user_id, 'first_name': 'Load', 'last_name': f'Test{user_id}', 'screen_name': f'id{user_id}' if spec.isdigit() else spec})
+    return users
+
+def messages_send(values):
+    with lock:
+        state['sent'].append({
+            'peer_id': int(values.get('peer_id', 0)),
+            'message': values.get('message', ''),
+            'attachment': values.get('attachment', ''),
+            'time': time.time(),
+        })
+        return len(state['sent'])
+
+def upload_server(kind):
+    return {'upload_url': request.host_url+'upload/'+kind, 'album_id': -1, 'user_id': 0}
+
+def photos_save(values):
+    return [{'id': next_id(), 'owner_id': -1, 'album_id': -1}]
+
+def docs_save(values):
+    return {'type': 'doc', 'doc': {'id': next_id(), 'owner_id': -1, 'title': values.get('title', '')}}
+
+METHODS = {
+    'storage.get': storage_get,
+    'storage.set': storage_set,
+    'users.get': users_get,
+    'messages.send': messages_send,
+    'photos.getMessagesUploadServer': lambda values: upload_server('photo'),
+    'photos.saveMessagesPhoto': photos_save,
+    'docs.getMessagesUploadServer': lambda values: upload_server('doc'),
+    'docs.save': docs_save,
+}
+
+def call(method, values):
+    if method not in METHODS:
+        raise KeyError(method)
+    return METHODS[method](values)
+
+def execute(code):
+    '''Run the two kinds of VKScript that vk_api's VkRequestsPool generates: one method over a list, or a list of calls.'''
+    decoder = json.JSONDecoder()
+    one_method = re.search(r'API\.([\w.]+)\(values\[i\]\)', code)
+    if one_method:
+        start = code.index('var values = ')+len('var values = ')
+        calls = [(one_method.group(1), values) for values in decoder.raw_decode(code, start)[0]]
+    else:
+        calls = []
+        for match in re.finditer(r'API\.([\w.]+)\(', code):
+            calls.append((match.group(1), decoder.raw_decode(code, match.end())[0]))
+    response, errors = [], []
+    for method, values in calls:
+        try:
+            response.append(call(method, values))
+        except KeyError:
+            response.append(False)
+            errors.append({'method': method, 'error_code': 3, 'error_msg': 'Unknown method passed'})
+    return {'response': response, 'execute_errors': errors}
+
+@app.route('/method/<method>', methods=['GET', 'POST'])
+def api_method(method):
+    time.sleep(state['latency'])
+    values = request.values.to_dict()
+    if method == 'execute':
+        return jsonify(execute(values['code']))
+    try:
+        return jsonify({'response': call(method, values)})
+    except KeyError:
+        return jsonify({'error': {'error_code': 3, 'error_msg': 'Unknown method passed', 'request_params': []}})
+
+@app.route('/upload/<kind>', methods=['POST'])
+def upload(kind):
+    time.sleep(state['latency'])
+    data = next(iter(request.files.values())).read()
+    if kind == 'photo':
+        return jsonify({'server': 1, 'photo': json.dumps([{'size': len(data)}]), 'hash': 'emulated'})
+    return jsonify({'file': f'emulated|{len(data)}'})
+
+@app.route('/sent')
+def sent():
+    after = int(request.args.get('after', 0))
+    with lock:
+        return jsonify({'total': len(state['sent']), 'messages': state['sent'][after:]})
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Emulate the VK API for load tests.')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to every API call and upload')
+    parser.add_argument('--code-in-caption', action='store_true', help='start every user with their code shown in captions, so deliveries can be matched to messages')
+    args = parser.parse_args(argv)
+    state['latency'] = args.latency
+    if args.code_in_caption:
+        state['defaults']['code_in_caption'] = 'True'
+    app.run(host=args.host, port=args.port, threaded=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+'''
+Render benchmark: runs the expressions in bench_corpus.json through the renderer and reports how long every stage took.
+
+Run it inside the renderer image, so that TeX, Ghostscript and the format cache are the real ones, e.g.:
+
+    docker-compose run --rm --entrypoint python renderer benchmark.py --dpi 300,1200 --workers 1,4 --output /cache/bench.json
+
+In "converter" mode (the default) it calls LatexConverter directly. In "task" mode it runs the whole render task
+and its delivery task in-process, with every VK call answered by a stub, so it also needs the database.
+Every case is rendered for every DPI and every preamble it applies to. The corpus lists preambles as lines added
+after the default preamble, with null meaning the default preamble itself. The JSON report has every run,
+p50/p95/p99 per stage, throughput per worker count, and peak RSS, so runs can be compared with a diff or a script.
+'''
+from data_managers import DEFAULT_PREAMBLE
+from latex_renderer import LatexConverter
+import multiprocessing
+import statistics
+import argparse
+import platform
+import resource
+import datetime
+import time
+import uuid
+import json
+import sys
+import os
+
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_corpus.json')
+CONVERTER_STAGES = {'pdflatex': 'pdflatex', 'getBounds': 'bbox', 'convertPdfToPng': 'rasterize', 'encodePng': 'encode', 'cropPdf': 'crop'}
+
+class StubVkMethod:
+    '''Answers any VK API method with a canned response, like vk_api's method proxy would with real ones.'''
+    RESPONSES = {
+        'storage.get': [],
+        'users.get': [{'id': 1, 'screen_name': 'benchmark'}],
+        'photos.getMessagesUploadServer': {'upload_url': 'http://stub/photo'},
+        'photos.saveMessagesPhoto': [{'owner_id': 1, 'id': 1}],
+        'docs.getMessagesUploadServer': {'upload_url': 'http://stub/doc'},
+        'docs.save': {'doc': {'owner_id': 1, 'id': 1}},
+        'messages.send': 1,
+    }
+    def __init__(self, method=None):
+        self.method = method
+
+    def __getattr__(self, name):
+        return StubVkMethod(name if self.method is None else self.method+'.'+name)
+
+    def __call__(self, **values):
+        return self.RESPONSES.get(self.method, 1)
+
+class StubHttpResponse:
+    def json(self):
+        return {}
+
+class StubHttp:
+    def post(self, url, **kwargs):
+        for name, (filename, data) in kwargs.get('files', {}).items():
+            len(data)  # make sure the payload was produced, as a real upload would
+        return StubHttpResponse()
+
+def instrument(obj, name, stage, timings):
+    '''Wrap a bound method so the time spent in it is added to timings[stage].'''
+    method = getattr(obj, name)
+    def timed(*args, **kwargs):
+        t1 = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            timings[stage] = timings.get(stage, 0) + time.perf_counter()-t1
+    setattr(obj, name, timed)
+
+class ConverterRunner:
+    def __init__(self):
+        self.timings = {}
+        self.conv = LatexConverter(StubVkMethod())
+        for name, stage in CONVERTER_STAGES.items():
+            instrument(self.conv, name, stage, self.timings)
+
+    def run(self, job):
+        self.conv.convertExpressionToPng(job['expression'], 1, uuid.uuid4().hex, returnPdf=job['pdf'], preamble=job['preamble'], dpi=job['dpi'])
+
+class TaskRunner:
+    def __init__(self):
+        import latex_celery_tasks as tasks
+        self.tasks = tasks
+        self.timings = {}
+        stub = StubVkMethod()
+        tasks.cel.conf.task_always_eager = True  # deliver tasks run right here instead of going to the broker
+        tasks.api = tasks.conv.api = tasks.uploader.api = tasks.utils.api = stub
+        tasks.uploader.ensure_process_state()
+        tasks.uploader.http = StubHttp()
+        # what the task would report to the user or the owner is kept here, and render stats are not written
+        tasks.stats.record_render = lambda *args, **kwargs: None
+        tasks.ERROR = lambda trace, user_id=None, text=None: self.errors.append(trace) or 'benchmark'
+        tasks.deliver_message = StubTask(lambda peer_id, message, sender=None: self.errors.append(message))
+        for name, stage in CONVERTER_STAGES.items():
+            instrument(tasks.conv, name, stage, self.timings)
+        instrument(tasks.uploader, 'upload', 'upload', self.timings)
+
+    def run(self, job):
+        self.errors = []
+        # a unique comment keeps the render cache from answering repeated runs of the same case
+        text = job['expression']+'\n%'+uuid.uuid4().hex
+        self.tasks.render_task(1, 1 if job['pdf'] else 2000000001, text, job['dpi'], job['preamble'])
+        if self.errors:
+            raise ValueError(self.errors[0])
+
+class StubTask:
+    def __init__(self, fn):
+        self.fn = fn
+
+    def delay(self, *args, **kwargs):
+        return self.fn(*args, **kwargs)
+
+def init_worker(mode):
+    global runner
+    runner = TaskRunner() if mode == 'task' else ConverterRunner()
+
+def run_job(job):
+    runner.timings.clear()
+    error = None
+    t1 = time.perf_counter()
+    try:
+        runner.run(job)
+    except ValueError as e:  # what the renderer raises for bad input
+        error = str(e.args[0] if e.args else e)
+    total = time.perf_counter()-t1
+    return {
+        'case': job['case'], 'category': job['category'], 'preamble_name': job['preamble_name'], 'dpi': job['dpi'],
+        'expect_error': job['expect_error'], 'error': error, 'total': total, 'stages': dict(runner.timings),
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'max_child_rss_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    }
+
+def load_corpus(path):
+    with open(path) as f:
+        corpus = json.load(f)
+    preambles = {}
+    for name, extra in corpus['preambles'].items():
+        preambles[name] = DEFAULT_PREAMBLE.strip() if extra is None else DEFAULT_PREAMBLE.strip()+'\n'+extra
+    return corpus, preambles
+
+def make_jobs(corpus, preambles, dpis, repeat, pdf, only=None):
+    jobs = []
+    for case in corpus['cases']:
+        if only and case['name'] not in only and case['category'] not in only:
+            continue
+        for preamble_name in case.get('preambles', list(preambles)):
+            for dpi in dpis:
+                for _ in range(repeat):
+                    jobs.append({'case': case['name'], 'category': case['category'], 'expression': case['expression'],
+                                 'expect_error': case.get('expect_error', False), 'preamble_name': preamble_name,
+                                 'preamble': preambles[preamble_name], 'dpi': dpi, 'pdf': pdf})
+    return jobs
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    index = fraction*(len(values)-1)
+    lower = int(index)
+    upper = min(lower+1, len(values)-1)
+    return values[lower] + (values[upper]-values[lower])*(index-lower)
+
+def summarize(values):
+    return {'count': len(values), 'mean': statistics.mean(values) if values else None,
+            'p50': percentile(values, 0.5), 'p95': percentile(values, 0.95), 'p99': percentile(values, 0.99), 'max': max(values, default=None)}
+
+def stage_summary(results):
+    stages = {'total': [r['total'] for r in results]}
+    for result in results:
+        for stage, seconds in result['stages'].items():
+            stages.setdefault(stage, []).append(seconds)
+    return {stage: summarize(values) for stage, values in stages.items()}
+
+def run(jobs, mode, workers, warmup_jobs):
+    '''Run all jobs over a pool of worker processes; returns the results and the wall time the jobs took.'''
+    ctx = multiprocessing.get_context('fork')
+    with ctx.Pool(workers, initializer=init_worker, initargs=(mode,)) as pool:
+        # every worker dumps its formats and parks TeX engines before the clock starts, as a long-running worker would have
+        pool.map(run_job, warmup_jobs*workers, chunksize=1)
+        t1 = time.perf_counter()
+        results = pool.map(run_job, jobs, chunksize=1)
+        wall = time.perf_counter()-t1
+    return results, wall
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the LaTeX renderer over the expression corpus.')
+    parser.add_argument('--corpus', default=CORPUS_PATH)
+    parser.add_argument('--mode', choices=['converter', 'task'], default='converter')
+    parser.add_argument('--dpi', default='300', help='comma-separated DPIs to render every case at')
+    parser.add_argument('--workers', default='1', help='comma-separated worker counts; the corpus is run once for each')
+    parser.add_argument('--repeat', type=int, default=3, help='renders of every case, DPI and preamble per worker count')
+    parser.add_argument('--pdf', action='store_true', help='also produce the cropped PDF, like private chats do')
+    parser.add_argument('--only', default='', help='comma-separated case names or categories to run')
+    parser.add_argument('--output', help='write the JSON report here instead of to stdout')
+    args = parser.parse_args(argv)
+
+    corpus, preambles = load_corpus(args.corpus)
+    dpis = [int(i) for i in args.dpi.split(',')]
+    only = [i for i in args.only.split(',') if i]
+    jobs = make_jobs(corpus, preambles, dpis, args.repeat, args.pdf, only)
+    warmup_jobs = [job for job in make_jobs(corpus, preambles, dpis[:1], 1, args.pdf) if job['category'] == 'trivial'][:1]
+    warmup_jobs = [dict(job, preamble_name=name, preamble=preamble) for job in warmup_jobs for name, preamble in preambles.items()]
+
+    report = {
+        'corpus_version': corpus['version'], 'mode': args.mode, 'dpis': dpis, 'repeat': args.repeat, 'pdf': args.pdf,
+        'started': datetime.datetime.now().isoformat(), 'host': platform.node(), 'python': platform.python_version(),
+        'cpus': os.cpu_count(), 'runs': [],
+    }
+    for workers in [int(i) for i in args.workers.split(',')]:
+        results, wall = run(jobs, args.mode, workers, warmup_jobs)
+        unexpected = [r['case'] for r in results if (r['error'] is not None) != r['expect_error']]
+        categories = sorted({r['category'] for r in results})
+        report['runs'].append({
+            'workers': workers,
+            'jobs': len(results),
+            'wall_seconds': wall,
+            'throughput': len(results)/wall if wall else None,
+            'unexpected_outcomes': sorted(set(unexpected)),
+            'peak_rss_kb': max(r['max_rss_kb'] for r in results),
+            'peak_child_rss_kb': max(r['max_child_rss_kb'] for r in results),
+            'stages': stage_summary(results),
+            'categories': {category: stage_summary([r for r in results if r['category'] == category]) for category in categories},
+            'results': results,
+        })
+        total = report['runs'][-1]['stages']['total']
+        print(f"{workers} workers: {len(results)} renders in {wall:.1f} s, {len(results)/wall:.2f}/s, "
+              f"p50 {total['p50']:.3f} s, p95 {total['p95']:.3f} s, p99 {total['p99']:.3f} s"
+              + (f", unexpected outcomes: {', '.join(sorted(set(unexpected)))}" if unexpected else ''), file=sys.stderr)
+
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1 @@
+../web_src/db_pool.py
\ No newline at end of file
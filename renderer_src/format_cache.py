@@ -0,0 +1,108 @@
+from subprocess import check_output, CalledProcessError, STDOUT, TimeoutExpired
+from data_managers import DEFAULT_PREAMBLE
+import hashlib
+import logging
+import time
+import uuid
+import os
+
+FORMAT_CACHE_DIR = os.getenv('FORMAT_CACHE_DIR', '/build/formats')
+FORMAT_CACHE_MAX_BYTES = int(os.getenv('FORMAT_CACHE_MAX_BYTES', 128*1024*1024))
+FAILED_RETRY_INTERVAL = 3600  # seconds before we try dumping a preamble that failed to dump again
+
+class FormatCache:
+    '''
+    On-disk LRU of precompiled pdflatex formats, one per distinct preamble.
+
+    Formats are dumped with mylatexformat, so a document compiled with the format
+    still contains its preamble text, but TeX skips it up to \\begin{document}
+    instead of loading all the packages again.
+    '''
+
+    logger = logging.getLogger(__name__)
+    def __init__(self, directory=FORMAT_CACHE_DIR, max_bytes=FORMAT_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+        self.pinned = {self.name_for(DEFAULT_PREAMBLE.strip())}  # most users have this one, never evict it
+
+    @property
+    def env(self):
+        # trailing colon makes kpathsea also search the default locations (needed for "&pdflatex" itself)
+        return dict(os.environ, TEXFORMATS=self.directory+':')
+
+    def name_for(self, preamble):
+        return 'preamble_'+hashlib.sha256(bytes(preamble, 'utf-8')).hexdigest()[:32]
+
+    def path_for(self, name):
+        return os.path.join(self.directory, name+'.fmt')
+
+    def find(self, preamble):
+        '''Return the name of the format for this preamble if it has been dumped, else None. Never dumps.'''
+        name = self.name_for(preamble)
+        try:
+            os.utime(self.path_for(name))  # mark as recently used
+            return name
+        except FileNotFoundError:
+            return None
+
+    def get(self, preamble):
+        '''Return the name of the format for this preamble, dumping it if needed, or None if it can't be dumped.'''
+        name = self.find(preamble)
+        if name is not None:
+            return name
+
+        name = self.name_for(preamble)
+        failed_marker = os.path.join(self.directory, name+'.failed')
+        try:
+            if time.time() - os.path.getmtime(failed_marker) < FAILED_RETRY_INTERVAL:
+                return None
+        except FileNotFoundError:
+            pass
+
+        if not self.dump(name, preamble):
+            open(failed_marker, 'w').close()
+            return None
+        self.evict()
+        return name
+
+    def dump(self, name, preamble):
+        jobname = name+'_'+uuid.uuid4().hex  # other worker processes may be dumping the same preamble
+        source = os.path.join(self.directory, jobname+'.tex')
+        with open(source, 'w') as f:
+            f.write(preamble+'\n\\begin{document}\n\\end{document}')
+        try:
+            check_output(['pdflatex', '-ini', '-interaction=nonstopmode', '-jobname='+jobname,
+                          '-output-directory', self.directory, '&pdflatex', 'mylatexformat.ltx', source],
+                         stderr=STDOUT, timeout=120, env=self.env)
+            os.replace(os.path.join(self.directory, jobname+'.fmt'), self.path_for(name))
+            self.logger.info('Dumped format %s', name)
+            return True
+        except (CalledProcessError, TimeoutExpired, FileNotFoundError):
+            self.logger.warning('Failed to dump format %s, will compile its preamble every time', name)
+            return False
+        finally:
+            for ext in ('tex', 'log', 'fmt'):
+                try:
+                    os.remove(os.path.join(self.directory, jobname+'.'+ext))
+                except FileNotFoundError:
+                    pass
+
+    def evict(self):
+        formats = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.fmt'):
+                stat = entry.stat()
+                formats.append((stat.st_mtime, stat.st_size, entry.name[:-4]))
+        total = sum(size for _, size, _ in formats)
+        for _, size, name in sorted(formats):
+            if total <= self.max_bytes:
+                break
+            if name in self.pinned:
+                continue
+            try:
+                os.remove(self.path_for(name))
+                self.logger.info('Evicted format %s', name)
+            except FileNotFoundError:  # another process got to it first
+                pass
+            total -= size
@@ -0,0 +1,83 @@
+from subprocess import run, check_output, CalledProcessError, PIPE, STDOUT
+import logging
+import io
+
+try:
+    import ghostscript  # python-ghostscript: drives libgs inside this process
+except (ImportError, RuntimeError):  # not installed, or libgs itself could not be loaded
+    ghostscript = None
+
+class GhostscriptEngine:
+    '''
+    Runs Ghostscript jobs given as argument lists (no shell involved).
+
+    With python-ghostscript available, the interpreter library is loaded once per worker process
+    and every job runs in it directly, instead of paying for a fork/exec of gs each time.
+    Otherwise jobs fall back to launching the gs binary.
+    Either way a failed job raises CalledProcessError carrying the interpreter's output.
+    Images and PDFs are written to stdout and returned as bytes, so they never touch the disk.
+    '''
+
+    logger = logging.getLogger(__name__)
+    def __init__(self, use_library=True):
+        self.use_library = use_library and ghostscript is not None
+        if use_library and not self.use_library:
+            self.logger.warning('python-ghostscript is not available, launching gs for every job')
+
+    def run(self, *args):
+        '''Run one job and return everything it printed (the bbox device prints to stderr), as text.'''
+        if not self.use_library:
+            return check_output(['gs']+list(args), stderr=STDOUT).decode('ascii', 'replace')
+
+        output = io.BytesIO()
+        try:
+            with ghostscript.Ghostscript('gs', *args, stdout=output, stderr=output):
+                pass
+        except ghostscript.GhostscriptError as e:
+            raise CalledProcessError(1, ['gs']+list(args), output.getvalue()) from e
+        return output.getvalue().decode('ascii', 'replace')
+
+    def run_to_bytes(self, *args):
+        '''Run one job that writes its output file to stdout (-sOutputFile=-) and return that file.'''
+        if not self.use_library:
+            process = run(['gs']+list(args), stdout=PIPE, stderr=PIPE)
+            if process.returncode != 0:
+                raise CalledProcessError(process.returncode, ['gs']+list(args), process.stderr.decode('ascii', 'replace'))
+            return process.stdout
+
+        output, messages = io.BytesIO(), io.BytesIO()
+        try:
+            with ghostscript.Ghostscript('gs', *args, stdout=output, stderr=messages):
+                pass
+        except ghostscript.GhostscriptError as e:
+            raise CalledProcessError(1, ['gs']+list(args), messages.getvalue().decode('ascii', 'replace')) from e
+        return output.getvalue()
+
+    def bounding_boxes(self, pathToPdf, lastPage=None):
+        '''Return a list with (llx, lly, urx, ury) of every page in PostScript points, from a single run.'''
+        args = ['-q', '-dBATCH', '-dNOPAUSE', '-dSAFER', '-sDEVICE=bbox']
+        if lastPage is not None:
+            args.append('-dLastPage=%d'%lastPage)
+        output = self.run(*args, pathToPdf)
+        boxes = []
+        for line in output.split('\n'):
+            if line.startswith('%%BoundingBox:'):
+                boxes.append(tuple(int(_) for _ in line.split(':')[1].split()))
+        if not boxes:
+            raise CalledProcessError(0, ['gs', pathToPdf], output)
+        return boxes
+
+    def bounding_box(self, pathToPdf):
+        '''Return (llx, lly, urx, ury) of the first page.'''
+        return self.bounding_boxes(pathToPdf, lastPage=1)[0]
+
+    def rasterize(self, pathToPdf, dpi, width, height, translation_x, translation_y, page=1):
+        '''Return one page as PNG bytes.'''
+        return self.run_to_bytes('-q', '-dBATCH', '-dNOPAUSE', '-dSAFER', '-sDEVICE=pngalpha', '-sOutputFile=-',
+                                 '-r%d'%dpi, '-g%dx%d'%(width, height), '-dFirstPage=%d'%page, '-dLastPage=%d'%page,
+                                 '-c', '<</Install {%d %d translate}>> setpagedevice'%(translation_x, translation_y), '-f', pathToPdf)
+
+    def crop(self, pathToPdf, bounds):
+        '''Return the PDF with its pages cropped to bounds, as bytes.'''
+        return self.run_to_bytes('-q', '-dBATCH', '-dNOPAUSE', '-dSAFER', '-sDEVICE=pdfwrite', '-sOutputFile=-',
+                                 '-c', '[/CropBox [%d %d %d %d] /PAGES pdfmark'%bounds, '-f', pathToPdf)
@@ -1,8 +1,15 @@
 # adapted from https://github.com/vdrhtc/InLaTeXbot/blob/master/src/LatexConverter.py for this project, used under the terms of GPL-3
-from subprocess import check_output, CalledProcessError, STDOUT, TimeoutExpired
+from subprocess import CalledProcessError, TimeoutExpired
 from data_managers import *
+from format_cache import FormatCache
+from gs_engine import GhostscriptEngine
+from png_encoder import PngEncoder
+from tex_pool import TexEngine, TexEnginePool
+from metrics import StageTimer
 import logging
+import glob
 import io
+import os
 
 class LatexConverter():
 
@@ -11,14 +18,44 @@ class LatexConverter():
         self.api = vk_api
         self.preamble_manager=PreambleManager(self.api)
         self.user_opts_manager = UserOptsManager(self.api)
+        self.format_cache = FormatCache()
+        self.gs = GhostscriptEngine()
+        self.png = PngEncoder()
+        self._pool = None
+        self._pool_pid = None
 
-    def extractBoundingBox(self, dpi, pathToPdf):
+    @property
+    def pool(self):
+        # engines are tied to the process that started them, so each forked worker gets its own pool
+        if self._pool_pid != os.getpid():
+            self._pool = TexEnginePool(self.format_cache.env)
+            self._pool_pid = os.getpid()
+        return self._pool
+
+    def close_pool(self):
+        '''Discard this process's parked engines; for processes that exit without running atexit handlers.'''
+        if self._pool_pid == os.getpid():
+            self._pool.close()
+
+    def dump_default_format(self):
+        '''Make sure the format for the default preamble, which most users have, is dumped.'''
+        self.format_cache.get(DEFAULT_PREAMBLE.strip())
+
+    def prewarm(self):
+        '''Park engines for the default preamble if its format is dumped. Only starts processes, so it is quick.'''
+        fmt = self.format_cache.find(DEFAULT_PREAMBLE.strip())
+        if fmt is not None:
+            self.pool.warm(fmt)
+
+    def getBounds(self, pathToPdf, allPages=False):
         try:
-            bbox = check_output("gs -q -dBATCH -dNOPAUSE -sDEVICE=bbox "+pathToPdf, 
-                                stderr=STDOUT, shell=True).decode("ascii")
+            if allPages:
+                return self.gs.bounding_boxes(pathToPdf)
+            return self.gs.bounding_box(pathToPdf)
         except CalledProcessError:
             raise ValueError('Failed while getting result bounding box. Your expression is invalid somehow.\nIf you think your expression is valid, please contact this bot\'s admin.')
-        bounds = [int(_) for _ in bbox[bbox.index(":")+2:bbox.index("\n")].split(" ")]
+
+    def extractBoundingBox(self, dpi, bounds):
         llc = bounds[:2]
         ruc = bounds[2:]
         size_factor = dpi/72
@@ -47,58 +84,116 @@ class LatexConverter():
             if line[:2]=="! ":
                 return "".join(log[idx:idx+2])
         
-    def pdflatex(self, fileName):
+    def pdflatex(self, source, sessionId, fmt=None):
+        '''Compile the document; returns the job name that the output files in /build are named after.'''
+        if fmt is None:
+            engine = TexEngine(None, self.format_cache.env, "expression_file_%s"%sessionId)
+        else:
+            engine = self.pool.take(fmt)
         try:
-            check_output(['pdflatex', "-interaction=nonstopmode", "-output-directory", 
-                    "/build", fileName], stderr=STDOUT, timeout=120)
-        except CalledProcessError as inst:
-            with open(fileName[:-3]+"log", "r") as f:
-                msg = self.getError(f.readlines())
-                self.logger.warn(msg)
-                raise ValueError(msg)
+            returncode = engine.run(source)
         except TimeoutExpired:
-                msg = "Your render job took too long and had to be killed. Please try again or try simplifying your job."
-                raise ValueError(msg)
+            self.cleanup(engine.jobName)
+            msg = "Your render job took too long and had to be killed. Please try again or try simplifying your job."
+            raise ValueError(msg)
+        if returncode != 0:
+            try:
+                if fmt is not None and not os.path.exists(self.format_cache.path_for(fmt)):
+                    # evicted by another worker between lookup and launch
+                    return self.pdflatex(source, sessionId)
+                with open("build/%s.log"%engine.jobName, "r") as f:
+                    msg = self.getError(f.readlines())
+                    self.logger.warn(msg)
+                    raise ValueError(msg)
+            finally:
+                self.cleanup(engine.jobName)
+        return engine.jobName
     
-    def cropPdf(self, sessionId):
-        bbox = check_output("gs -q -dBATCH -dNOPAUSE -sDEVICE=bbox build/expression_file_%s.pdf"%sessionId, 
-                            stderr=STDOUT, shell=True).decode("ascii")
-        bounds = tuple([int(_) for _ in bbox[bbox.index(":")+2:bbox.index("\n")].split(" ")])
-
-        command_crop = 'gs -o build/expression_file_cropped_%s.pdf -sDEVICE=pdfwrite\
-                         -c "[/CropBox [%d %d %d %d]"   -c " /PAGES pdfmark" -f build/expression_file_%s.pdf'\
-                         %((sessionId,)+bounds+(sessionId,))
-        check_output(command_crop, stderr=STDOUT, shell=True)
-
-    def convertPdfToPng(self, dpi, sessionId, bbox):
-        command = 'gs  -o build/expression_%s.png -r%d -sDEVICE=pngalpha  -g%dx%d  -dLastPage=1 \
-                    -c "<</Install {%d %d translate}>> setpagedevice" -f build/expression_file_%s.pdf'\
-                    %((sessionId, dpi)+bbox+(sessionId,))
-        check_output(command, stderr=STDOUT, shell=True)
-
-    def convertExpressionToPng(self, expression, userId, sessionId, returnPdf = False):
-        preamble=self.preamble_manager.get(userId)
+    def cropPdf(self, jobName, bounds):
+        return io.BytesIO(self.gs.crop("build/%s.pdf"%jobName, bounds))
+
+    def convertPdfToPng(self, dpi, jobName, bbox, page=1):
+        return self.gs.rasterize("build/%s.pdf"%jobName, dpi, *bbox, page=page)
+
+    def encodePng(self, png):
+        return io.BytesIO(self.png.encode(png))
+
+    def cleanup(self, jobName):
+        for path in glob.glob("build/%s*"%glob.escape(jobName)):
+            os.remove(path)
+
+    def convertExpressionToPng(self, expression, userId, sessionId, returnPdf = False, preamble=None, dpi=None, timer=None):
+        timer = timer or StageTimer()
+        if preamble is None:
+            preamble=self.preamble_manager.get(userId)
         fileString = preamble+"\n\\begin{document}\n"+expression+"\n\\end{document}"
-        with open("build/expression_file_%s.tex"%sessionId, "w+") as f:
-            f.write(fileString)
 
-        dpi = self.user_opts_manager.get_dpi(userId)
+        if dpi is None:
+            dpi = self.user_opts_manager.get_dpi(userId)
+        with timer.stage('format'):
+            fmt = self.format_cache.get(preamble)
+        with timer.stage('pdflatex'):
+            jobName = self.pdflatex(fileString, sessionId, fmt)
         try:
-            self.pdflatex("build/expression_file_%s.tex"%sessionId)
-            bbox = self.extractBoundingBox(dpi, "build/expression_file_%s.pdf"%sessionId)
+            with timer.stage('bbox'):
+                bounds = self.getBounds("build/%s.pdf"%jobName)  # computed once, used for both the image and the crop
+            bbox = self.extractBoundingBox(dpi, bounds)
             bbox = self.correctBoundingBoxAspectRaito(dpi, bbox)
-            self.convertPdfToPng(dpi, sessionId, bbox)
+            with timer.stage('rasterize'):
+                png = self.convertPdfToPng(dpi, jobName, bbox)
             self.logger.debug("Generated image for %s", expression)
-            with open("build/expression_%s.png"%sessionId, "rb") as f:
-                imageBinaryStream = io.BytesIO(f.read())
+            with timer.stage('encode'):
+                imageBinaryStream = self.encodePng(png)
 
             if returnPdf:
-                self.cropPdf(sessionId)
-                with open("build/expression_file_cropped_%s.pdf"%sessionId, "rb") as f:
-                    pdfBinaryStream = io.BytesIO(f.read())
+                with timer.stage('crop'):
+                    pdfBinaryStream = self.cropPdf(jobName, bounds)
                 return imageBinaryStream, pdfBinaryStream
             else:
                 return imageBinaryStream
                 
         finally:
-            check_output(["rm build/*_%s.*"%sessionId], stderr=STDOUT, shell=True)
+            self.cleanup(jobName)
+
+    def convertExpressionsToPngs(self, expressions, userId, sessionId, returnPdf = False, preamble=None, dpi=None, timer=None):
+        '''
+        Render several expressions in one TeX run, one per page, so the engine start and preamble are paid once.
+        Returns a list of PNG streams, and the PDF cropped to the union of all pages' boxes if returnPdf.
+        Stage times are added to timer, if given.
+        '''
+        timer = timer or StageTimer()
+        if preamble is None:
+            preamble=self.preamble_manager.get(userId)
+        fileString = preamble+"\n\\begin{document}\n"+"\n\\clearpage\n".join(expressions)+"\n\\end{document}"
+
+        if dpi is None:
+            dpi = self.user_opts_manager.get_dpi(userId)
+        with timer.stage('format'):
+            fmt = self.format_cache.get(preamble)
+        with timer.stage('pdflatex'):
+            jobName = self.pdflatex(fileString, sessionId, fmt)
+        try:
+            with timer.stage('bbox'):
+                pageBounds = self.getBounds("build/%s.pdf"%jobName, allPages=True)
+            if len(pageBounds) != len(expressions):
+                raise ValueError(f'Got {len(pageBounds)} pages for {len(expressions)} expressions. Every expression must fit on one page and produce some output.')
+            images = []
+            for page, bounds in enumerate(pageBounds, 1):
+                bbox = self.extractBoundingBox(dpi, bounds)
+                bbox = self.correctBoundingBoxAspectRaito(dpi, bbox)
+                with timer.stage('rasterize'):
+                    png = self.convertPdfToPng(dpi, jobName, bbox, page)
+                with timer.stage('encode'):
+                    images.append(self.encodePng(png))
+            self.logger.debug("Generated %d images for %s", len(images), expressions)
+
+            if returnPdf:
+                union = (min(b[0] for b in pageBounds), min(b[1] for b in pageBounds), max(b[2] for b in pageBounds), max(b[3] for b in pageBounds))
+                with timer.stage('crop'):
+                    pdfBinaryStream = self.cropPdf(jobName, union)
+                return images, pdfBinaryStream
+            else:
+                return images
+
+        finally:
+            self.cleanup(jobName)
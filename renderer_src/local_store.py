@@ -0,0 +1 @@
+../web_src/local_store.py
\ No newline at end of file
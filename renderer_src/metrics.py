@@ -0,0 +1 @@
+../web_src/metrics.py
\ No newline at end of file
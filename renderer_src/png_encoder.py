@@ -0,0 +1,85 @@
+from metrics import png_bytes, png_encodings_total
+import logging
+import math
+import io
+import os
+
+try:
+    from PIL import Image, ImageChops, ImageStat
+except ImportError:
+    Image = None
+
+PNG_COMPRESS_LEVEL = int(os.getenv('PNG_COMPRESS_LEVEL', 6))  # zlib level, 0-9: higher is smaller and slower
+PNG_MAX_PIXELS = int(os.getenv('PNG_MAX_PIXELS', 0))  # images with more pixels are scaled down to this many; 0 turns this off
+
+class PngEncoder:
+    '''
+    Re-encodes the RGBA PNGs Ghostscript produces in the smallest lossless form that fits their contents.
+
+    Most formulas are one colour over a transparent background, so all the information is in the alpha channel:
+    those become palette images with one entry per alpha level, a byte per pixel instead of four. Formulas
+    in shades of grey become grey+alpha; anything with colour stays RGBA. The result is only used if it is smaller.
+    Without Pillow images are passed through unchanged.
+    '''
+
+    logger = logging.getLogger(__name__)
+    def __init__(self, compress_level=PNG_COMPRESS_LEVEL, max_pixels=PNG_MAX_PIXELS):
+        self.compress_level = compress_level
+        self.max_pixels = max_pixels
+        if Image is None:
+            self.logger.warning('Pillow is not available, PNGs are sent as Ghostscript wrote them')
+
+    @property
+    def settings(self):
+        '''Everything that changes the output for the same input, for the render cache key.'''
+        if Image is None:
+            return 'passthrough'
+        return f'level={self.compress_level},max_pixels={self.max_pixels}'
+
+    def encode(self, data):
+        '''Take PNG bytes and return the bytes to send.'''
+        png_bytes.labels('raw').observe(len(data))
+        if Image is None:
+            png_encodings_total.labels('passthrough').inc()
+            png_bytes.labels('encoded').observe(len(data))
+            return data
+
+        image = Image.open(io.BytesIO(data)).convert('RGBA')
+        original_size = image.size
+        mode, image, options = self.reduce(self.limit_size(image))
+        output = io.BytesIO()
+        image.save(output, 'PNG', compress_level=self.compress_level, **options)
+        encoded = output.getvalue()
+        if len(encoded) >= len(data) and image.size == original_size:
+            mode, encoded = 'passthrough', data
+        png_encodings_total.labels(mode).inc()
+        png_bytes.labels('encoded').observe(len(encoded))
+        return encoded
+
+    def limit_size(self, image):
+        width, height = image.size
+        if not self.max_pixels or width*height <= self.max_pixels:
+            return image
+        scale = math.sqrt(self.max_pixels/(width*height))
+        return image.resize((max(1, int(width*scale)), max(1, int(height*scale))), Image.LANCZOS)
+
+    def reduce(self, image):
+        '''Return the mode name for metrics, the image to save, and extra options for saving it.'''
+        red, green, blue, alpha = image.split()
+        visible = alpha.point(lambda a: 255 if a else 0)
+        if visible.getbbox() is None:
+            extrema = [(0, 0)]*3
+        else:
+            extrema = ImageStat.Stat(image.convert('RGB'), visible).extrema
+
+        if all(low == high for low, high in extrema):
+            # one colour everywhere it shows: palette entry i is that colour with alpha i
+            palette = [int(low) for low, high in extrema]*256
+            image = alpha.copy()
+            image.putpalette(palette)
+            return 'palette', image, {'transparency': bytes(range(256))}
+
+        if all(ImageStat.Stat(ImageChops.difference(a, b), visible).extrema[0][1] == 0 for a, b in [(red, green), (green, blue)]):
+            return 'grey', Image.merge('LA', (red, alpha)), {}
+
+        return 'rgba', image, {}
@@ -0,0 +1 @@
+../web_src/render_cache.py
\ No newline at end of file
@@ -0,0 +1 @@
+../web_src/scheduler.py
\ No newline at end of file
@@ -0,0 +1,111 @@
+'''
+Golden-image test: GhostscriptEngine must produce the same pixels as the shell pipeline it replaced.
+
+Needs pdflatex, gs and Pillow, so it is meant to run inside the renderer image:
+
+    docker-compose run --rm --entrypoint python renderer -m unittest test_gs_engine
+
+and is skipped wherever they are missing.
+'''
+from subprocess import check_output, STDOUT
+from gs_engine import GhostscriptEngine, ghostscript
+import tempfile
+import unittest
+import shutil
+import io
+import os
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+PREAMBLE = '\\documentclass[12pt]{article}\n\\usepackage{amsmath}\n\\usepackage{amssymb}\n\\pagestyle{empty}'
+EXPRESSIONS = [
+    '$E=mc^2$',
+    '$$\\int_0^\\infty e^{-x^2}\\,dx = \\frac{\\sqrt{\\pi}}{2}$$',
+    '$$\\begin{pmatrix} a & b \\\\ c & d \\end{pmatrix}^{-1} = \\frac{1}{ad-bc}\\begin{pmatrix} d & -b \\\\ -c & a \\end{pmatrix}$$',
+    '$$\\sum_{n=1}^{\\infty} \\frac{1}{n^2} = \\frac{\\pi^2}{6}$$',
+]
+DPIS = [300, 1200]
+
+def pixels(png):
+    image = Image.open(io.BytesIO(png)).convert('RGBA')
+    return image.size, image.tobytes()
+
+@unittest.skipUnless(shutil.which('gs') and shutil.which('pdflatex') and Image is not None, 'needs gs, pdflatex and Pillow')
+class GoldenImageTest(unittest.TestCase):
+    '''Renders every expression through the old shell commands and through the engine, and compares the results.'''
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.pdfs = []
+        for index, expression in enumerate(EXPRESSIONS):
+            with open(os.path.join(cls.directory, 'expression_%d.tex'%index), 'w') as f:
+                f.write(PREAMBLE+'\n\\begin{document}\n'+expression+'\n\\end{document}')
+            check_output(['pdflatex', '-interaction=nonstopmode', '-output-directory', cls.directory, 'expression_%d.tex'%index],
+                         stderr=STDOUT, cwd=cls.directory, timeout=120)
+            cls.pdfs.append(os.path.join(cls.directory, 'expression_%d.pdf'%index))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def engines(self):
+        yield 'subprocess', GhostscriptEngine(use_library=False)
+        if ghostscript is not None:
+            yield 'library', GhostscriptEngine()
+
+    def shell_bounds(self, pdf):
+        bbox = check_output("gs -q -dBATCH -dNOPAUSE -sDEVICE=bbox "+pdf, stderr=STDOUT, shell=True).decode("ascii")
+        return tuple(int(_) for _ in bbox[bbox.index(":")+2:bbox.index("\n")].split(" "))
+
+    def shell_png(self, pdf, dpi, bbox):
+        png = os.path.join(self.directory, 'shell.png')
+        check_output('gs  -o %s -r%d -sDEVICE=pngalpha  -g%dx%d  -dLastPage=1 -c "<</Install {%d %d translate}>> setpagedevice" -f %s'
+                     %((png, dpi)+bbox+(pdf,)), stderr=STDOUT, shell=True)
+        with open(png, 'rb') as f:
+            return f.read()
+
+    def shell_crop(self, pdf, bounds):
+        cropped = os.path.join(self.directory, 'shell_cropped.pdf')
+        check_output('gs -o %s -sDEVICE=pdfwrite -c "[/CropBox [%d %d %d %d]"   -c " /PAGES pdfmark" -f %s'
+                     %((cropped,)+bounds+(pdf,)), stderr=STDOUT, shell=True)
+        with open(cropped, 'rb') as f:
+            return f.read()
+
+    def render_pdf(self, data):
+        '''Rasterize a whole PDF given as bytes, to compare two PDFs by what they show.'''
+        pdf = os.path.join(self.directory, 'compare.pdf')
+        with open(pdf, 'wb') as f:
+            f.write(data)
+        return check_output(['gs', '-q', '-dBATCH', '-dNOPAUSE', '-dUseCropBox', '-sDEVICE=pngalpha', '-r150', '-sOutputFile=-', pdf])
+
+    def test_bounding_box(self):
+        for pdf in self.pdfs:
+            for name, engine in self.engines():
+                with self.subTest(pdf=pdf, engine=name):
+                    self.assertEqual(engine.bounding_box(pdf), self.shell_bounds(pdf))
+
+    def test_rasterize(self):
+        for pdf in self.pdfs:
+            bounds = self.shell_bounds(pdf)
+            for dpi in DPIS:
+                # the box LatexConverter.extractBoundingBox derives from the bounds
+                bbox = ((bounds[2]-bounds[0])*dpi/72, (bounds[3]-bounds[1])*dpi/72, -bounds[0], -bounds[1])
+                expected = pixels(self.shell_png(pdf, dpi, bbox))
+                for name, engine in self.engines():
+                    with self.subTest(pdf=pdf, dpi=dpi, engine=name):
+                        self.assertEqual(pixels(engine.rasterize(pdf, dpi, *bbox)), expected)
+
+    def test_crop(self):
+        for pdf in self.pdfs:
+            bounds = self.shell_bounds(pdf)
+            expected = pixels(self.render_pdf(self.shell_crop(pdf, bounds)))
+            for name, engine in self.engines():
+                with self.subTest(pdf=pdf, engine=name):
+                    self.assertEqual(pixels(self.render_pdf(engine.crop(pdf, bounds))), expected)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+from subprocess import Popen, PIPE, DEVNULL, TimeoutExpired
+from collections import OrderedDict
+import logging
+import atexit
+import glob
+import time
+import uuid
+import os
+import re
+
+PDFLATEX_POOL_SIZE = int(os.getenv('PDFLATEX_POOL_SIZE', 1))  # warm engines kept per preamble, per worker process
+PDFLATEX_POOL_FORMATS = int(os.getenv('PDFLATEX_POOL_FORMATS', 2))  # how many distinct preambles are kept warm, most recently used first
+PDFLATEX_POOL_MAX_AGE = int(os.getenv('PDFLATEX_POOL_MAX_AGE', 3600))  # seconds an engine may stay parked before it is replaced
+POOLED_JOB_NAME = re.compile(r'^expression_file_(\d+)_[0-9a-f]{32}')  # job names of pooled engines start with the pid of the process that owns them
+
+class TexEngine:
+    '''
+    A pdflatex process that has already started up, loaded its format, and is blocked reading the document from its stdin.
+
+    TeX cannot start a second document once one ends, so every engine serves exactly one job.
+    '''
+
+    def __init__(self, fmt, env, jobName=None, directory='/build'):
+        self.fmt = fmt
+        self.jobName = jobName or 'expression_file_%d_%s'%(os.getpid(), uuid.uuid4().hex)
+        self.directory = directory
+        self.started = time.time()
+        command = ['pdflatex', '-interaction=nonstopmode', '-output-directory', directory, '-jobname='+self.jobName]
+        if fmt is not None:
+            command.append('-fmt='+fmt)
+        command.append('\\input{/dev/stdin}')
+        self.process = Popen(command, stdin=PIPE, stdout=DEVNULL, stderr=DEVNULL, env=env)
+
+    @property
+    def alive(self):
+        return self.process.poll() is None
+
+    def run(self, source, timeout=120):
+        '''Feed the document and wait for TeX to finish. Returns the exit code; raises TimeoutExpired after killing it.'''
+        try:
+            self.process.communicate(bytes(source, 'utf-8'), timeout=timeout)
+        except TimeoutExpired:
+            self.kill()
+            raise
+        return self.process.returncode
+
+    def kill(self):
+        if self.alive:
+            self.process.kill()
+            self.process.wait()
+
+    def discard(self):
+        '''Kill an engine that will not be used, and remove whatever it already wrote, such as its log.'''
+        self.kill()
+        for path in glob.glob(os.path.join(self.directory, glob.escape(self.jobName)+'*')):
+            os.remove(path)
+
+class TexEnginePool:
+    '''
+    Per-process pool of parked TexEngines, grouped by format.
+
+    Taking an engine immediately starts its replacement, which boots while the current job is being
+    processed, so the next render for that preamble does not wait for TeX to start.
+    Must only be used after the worker process has forked: the engines' pipes belong to one process.
+
+    Engines that are never used are discarded along with their files in the build directory. A process that
+    exits without closing its pool (celery's prefork children skip atexit handlers, and may be killed) leaves
+    them behind, so a new pool also removes the files of engines whose process is gone.
+    '''
+
+    logger = logging.getLogger(__name__)
+    def __init__(self, env, size=PDFLATEX_POOL_SIZE, max_formats=PDFLATEX_POOL_FORMATS, max_age=PDFLATEX_POOL_MAX_AGE, directory='/build'):
+        self.env = env
+        self.size = size
+        self.max_formats = max_formats
+        self.max_age = max_age
+        self.directory = directory
+        self.engines = OrderedDict()  # format name -> parked engines, least recently used format first
+        self.remove_orphans()
+        atexit.register(self.close)
+
+    def remove_orphans(self):
+        for path in glob.glob(os.path.join(self.directory, 'expression_file_*')):
+            match = POOLED_JOB_NAME.match(os.path.basename(path))
+            if match is None or process_alive(int(match.group(1))):
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:  # another worker process is sweeping too
+                pass
+
+    def warm(self, fmt):
+        '''Make sure there are enough parked engines for this format, and stop keeping the least recently used formats warm.'''
+        engines = self.engines.setdefault(fmt, [])
+        self.engines.move_to_end(fmt)
+        for engine in list(engines):
+            if not engine.alive or time.time()-engine.started > self.max_age:
+                engine.discard()
+                engines.remove(engine)
+        while len(engines) < self.size:
+            engines.append(TexEngine(fmt, self.env, directory=self.directory))
+        while len(self.engines) > self.max_formats:
+            _, evicted = self.engines.popitem(last=False)
+            for engine in evicted:
+                engine.discard()
+
+    def take(self, fmt):
+        '''Return a parked engine for this format, starting one now if none is ready.'''
+        self.warm(fmt)
+        if not self.engines[fmt]:  # pool size 0: no parking, just start one
+            return TexEngine(fmt, self.env, directory=self.directory)
+        engine = self.engines[fmt].pop(0)
+        self.warm(fmt)
+        return engine
+
+    def close(self):
+        for engines in self.engines.values():
+            for engine in engines:
+                engine.discard()
+        self.engines.clear()
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:  # exists, but belongs to another user
+        pass
+    return True
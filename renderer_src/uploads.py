@@ -0,0 +1,73 @@
+from concurrent.futures import ThreadPoolExecutor
+import requests.adapters
+import requests
+import threading
+import logging
+import time
+import os
+
+UPLOAD_THREADS = int(os.getenv('UPLOAD_THREADS', 4))
+
+class Uploader:
+    '''
+    Uploads render results to VK as message attachments.
+
+    Every worker process keeps one HTTP session with a connection pool, so upload servers are reached
+    over already-open connections, and the photos and the document are uploaded concurrently.
+    Each upload call reports how long every step took.
+    '''
+
+    logger = logging.getLogger(__name__)
+    def __init__(self, api, threads=UPLOAD_THREADS):
+        self.api = api
+        self.threads = threads
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def ensure_process_state(self):
+        # threads and sockets do not survive a fork, so each worker process builds its own;
+        # the lock keeps threads of the delivery pool from building two at once
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self.http = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=self.threads, pool_maxsize=self.threads)
+            self.http.mount('https://', adapter)
+            self.http.mount('http://', adapter)
+            self.executor = ThreadPoolExecutor(self.threads)
+            self._pid = os.getpid()
+
+    def timed(self, timings, step, fn, *args, **kwargs):
+        t1 = time.time()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            # concurrent uploads of the same kind overlap, so the slowest one is what the user waits for
+            timings[step] = max(timings.get(step, 0), time.time()-t1)
+
+    def upload_photo(self, png, peer_id, timings):
+        server = self.timed(timings, 'photo.get_server', self.api.photos.getMessagesUploadServer, peer_id=peer_id)['upload_url']
+        resp = self.timed(timings, 'photo.post', self.http.post, server, files={'photo': ('expression.png', png)}).json()
+        photo = self.timed(timings, 'photo.save', self.api.photos.saveMessagesPhoto, **resp)[0]
+        return f'photo{photo["owner_id"]}_{photo["id"]}'
+
+    def upload_doc(self, pdf, peer_id, timings):
+        server = self.timed(timings, 'doc.get_server', self.api.docs.getMessagesUploadServer, peer_id=peer_id)['upload_url']
+        resp = self.timed(timings, 'doc.post', self.http.post, server, files={'file': ('expression.pdf', pdf)}).json()
+        resp.update({'title': 'LaTeX expression', 'type': 'doc'})
+        doc = self.timed(timings, 'doc.save', self.api.docs.save, **resp)['doc']
+        return f'doc{doc["owner_id"]}_{doc["id"]}'
+
+    def upload(self, peer_id, pngs, pdf=None):
+        '''Upload all images (and the PDF, if given) at once. Returns the attachment string for messages.send and the step timings.'''
+        self.ensure_process_state()
+        timings = {}
+        t1 = time.time()
+        futures = [self.executor.submit(self.upload_photo, png, peer_id, timings) for png in pngs]
+        if pdf is not None:
+            futures.append(self.executor.submit(self.upload_doc, pdf, peer_id, timings))
+        attachments = [future.result() for future in futures]
+        timings['upload'] = time.time()-t1
+        return ','.join(attachments), timings
@@ -0,0 +1,57 @@
+from local_store import LocalStore
+import stats
+import math
+import os
+
+COST_MAX = float(os.getenv('COST_MAX', 60))  # estimated seconds above which a render is downscaled, or refused if that is not enough
+COST_MIN_DPI = 100  # downscaling never goes below this
+HISTORY_TTL = 600  # seconds the mean render times from the stats database are reused
+
+BASE_DPI = 300  # the default DPI, at which the historical times were mostly measured
+TEX_SHARE = 0.5  # part of a typical render spent in pdflatex, which does not depend on DPI
+DEFAULT_SECONDS = 2.0  # assumed time of a typical render before there is any history
+CHARS_PER_UNIT = 200  # an expression this long is taken to cover the area of a typical one
+PACKAGE_SECONDS = 0.05  # extra pdflatex time per \usepackage line beyond the default preamble's
+
+class CostModel:
+    '''
+    Estimates how many seconds a render will take, before it is queued.
+
+    A render is pdflatex time, which grows with the preamble and the number of expressions, plus
+    rasterization time, which grows with the square of the DPI and with the image area (approximated by
+    the expression length). Both are scaled by the user's own mean render time from the stats rollup,
+    falling back to everyone's mean, so users with habitually large documents are estimated higher.
+    '''
+
+    store = LocalStore()
+    def __init__(self, default_packages=0, max_cost=COST_MAX):
+        self.default_packages = default_packages
+        self.max_cost = max_cost
+
+    def mean_time(self, user_id):
+        key = f'cost.mean_time.{user_id}'
+        mean = self.store.get(key)
+        if mean is None:
+            mean = stats.get_mean_render_time(user_id) or stats.get_mean_render_time() or DEFAULT_SECONDS
+            self.store.set(key, mean, ttl=HISTORY_TTL)
+        return mean
+
+    def estimate(self, user_id, text, dpi, preamble='', expressions=1):
+        mean = self.mean_time(user_id)
+        packages = max(0, preamble.count('\\usepackage') - self.default_packages)
+        area = max(1, len(text)/CHARS_PER_UNIT)
+        tex = mean*TEX_SHARE*expressions + packages*PACKAGE_SECONDS
+        raster = mean*(1-TEX_SHARE)*area*(dpi/BASE_DPI)**2
+        return tex + raster
+
+    def max_dpi(self, user_id, text, dpi, preamble='', expressions=1):
+        '''Return the highest DPI not above dpi whose estimate fits max_cost, or None if even COST_MIN_DPI does not.'''
+        budget = self.max_cost
+        fixed = self.estimate(user_id, text, 0, preamble, expressions)
+        per_dpi2 = (self.estimate(user_id, text, BASE_DPI, preamble, expressions) - fixed)/BASE_DPI**2
+        if budget <= fixed:
+            return None
+        fitting = int(math.sqrt((budget-fixed)/per_dpi2))
+        if fitting < COST_MIN_DPI:
+            return None
+        return min(dpi, fitting)
@@ -1,10 +1,22 @@
+import hashlib
+import logging
+import base64
 import hmac
 import uuid
 import json
 import time
+import zlib
 import os
+from local_store import LocalStore
+from utils import VKBatch
 
-PREAMBLE_PARTS_COUNT = 512
+PREAMBLE_PARTS_COUNT = 512  # max lines in a preamble; also the number of keys in the legacy one-line-per-key layout
+
+PACKED_PREAMBLE_VERSION = 1
+PACKED_PREAMBLE_CHUNKS = 8
+PACKED_PREAMBLE_CHUNK_SIZE = 4000  # VK storage values are limited to 4096 characters
+
+PROFILE_TTL = int(os.getenv('PROFILE_TTL', 60))
 
 DEFAULT_PREAMBLE = '''
 \\documentclass{article}
@@ -19,9 +31,33 @@ DEFAULT_PREAMBLE = '''
 
 HMAC_SECRET = bytes(os.getenv('HMAC_SECRET'), 'utf-8')
 
+def write_storage(api, user_id, values, batch=None):
+    '''
+    Set several storage keys of one user, in order, as a single VK execute request.
+    If a VKBatch is given, the writes are queued there instead and sent with the rest of it.
+    The user's cached profile is dropped once the writes have gone out.
+    '''
+    own_batch = batch is None
+    if own_batch:
+        batch = VKBatch(api)
+    for key, value in values.items():
+        batch.storage_set(user_id=user_id, key=key, value=value)
+    batch.after(lambda: UserProfile(api).invalidate(user_id))
+    if own_batch:
+        batch.execute()
+
 class PreambleManager:
-    def __init__(self, api):
+    '''
+    Stores the preamble as a compressed JSON list of lines, split over a few storage keys:
+    "preamble_packed_meta" holds "version:chunk count:checksum", "preamble_packed_N" hold the chunks.
+    A read is one storage.get, a write is a single execute request setting the used chunks and the meta key.
+
+    Preambles in the old layout (one line per "preamble_part_N" key) are converted on first read.
+    '''
+    logger = logging.getLogger(__name__)
+    def __init__(self, api, batch=None):
         self.api = api
+        self.batch = batch
 
     def get(self, user_id):
         preamble = self.strip_empty(self.get_as_list(user_id))
@@ -29,27 +65,81 @@ class PreambleManager:
         return preamble
 
     @property
-    def keys(self):
+    def legacy_keys(self):
         key = []
         for i in range(PREAMBLE_PARTS_COUNT):
             key.append(f'preamble_part_{i}')
         return key
 
+    @property
+    def meta_key(self):
+        return 'preamble_packed_meta'
+
+    @property
+    def chunk_keys(self):
+        return [f'preamble_packed_{i}' for i in range(PACKED_PREAMBLE_CHUNKS)]
+
+    @property
+    def keys(self):
+        return [self.meta_key] + self.chunk_keys
+
     @property
     def default_preamble(self):
         return DEFAULT_PREAMBLE.strip().split('\n')
 
-    def get_as_list(self, user_id, init_if_empty=True):
-        data = self.api.storage.get(keys=','.join(self.keys), user_id=user_id)
-        preamble_arr = []
-        for element in data:
-            preamble_arr.append(element['value'])
+    def get_as_list(self, user_id, init_if_empty=True, for_update=False):
+        '''
+        Return the user's preamble lines. If the packed preamble cannot be decoded (corrupt, or a write still
+        in progress) nothing is written: reads fall back to the legacy keys or the default preamble, and reads
+        made to modify the preamble (for_update) raise a ValueError for the user instead.
+        '''
+        try:
+            preamble_arr = self.unpack(user_id, UserProfile(self.api).get(user_id))
+        except (ValueError, zlib.error):
+            self.logger.exception('Packed preamble of %s is unreadable, not touching it', user_id)
+            if for_update:
+                raise ValueError('Your stored preamble could not be read, so it was not changed. Please try again in a minute, or use /reset-preamble to start over.')
+            preamble_arr = self.get_legacy_list(user_id)
+            if not preamble_arr and init_if_empty:
+                preamble_arr = self.default_preamble
+            return preamble_arr
+        if preamble_arr is None:
+            preamble_arr = self.get_legacy_list(user_id)
+            if preamble_arr:
+                self.logger.info('Migrating preamble of %s to packed storage', user_id)
+                self.set_list(user_id, preamble_arr)
         if init_if_empty:
-            if len(self.strip_empty(preamble_arr)) == 0:
+            if len(preamble_arr) == 0:
                 self.set_list(user_id, self.default_preamble)
-                return self.pad_with_empty(self.default_preamble)
+                return self.default_preamble
         return preamble_arr
 
+    def get_legacy_list(self, user_id):
+        data = self.api.storage.get(keys=','.join(self.legacy_keys), user_id=user_id)
+        return self.strip_empty([element['value'] for element in data])
+
+    def pack(self, preamble_arr):
+        '''Return the values for the meta key and for each used chunk key.'''
+        payload = str(base64.b64encode(zlib.compress(bytes(json.dumps(preamble_arr), 'utf-8'), 9)), 'ascii')
+        chunks = [payload[i:i+PACKED_PREAMBLE_CHUNK_SIZE] for i in range(0, len(payload), PACKED_PREAMBLE_CHUNK_SIZE)]
+        if len(chunks) > PACKED_PREAMBLE_CHUNKS:
+            raise ValueError(f'Your preamble is too long! It takes {len(payload)} bytes compressed, the max is {PACKED_PREAMBLE_CHUNKS*PACKED_PREAMBLE_CHUNK_SIZE}.')
+        checksum = hashlib.sha1(bytes(payload, 'ascii')).hexdigest()
+        return f'{PACKED_PREAMBLE_VERSION}:{len(chunks)}:{checksum}', chunks
+
+    def unpack(self, user_id, values):
+        '''Decode the packed layout from storage values; None if it was never written. Raises ValueError or zlib.error if it is unreadable.'''
+        meta = values.get(self.meta_key)
+        if not meta:
+            return None
+        version, count, checksum = meta.split(':')
+        if int(version) != PACKED_PREAMBLE_VERSION:
+            raise ValueError(f'unknown version {version}')
+        payload = ''.join(values.get(key, '') for key in self.chunk_keys[:int(count)])
+        if not hmac.compare_digest(hashlib.sha1(bytes(payload, 'ascii')).hexdigest(), checksum):
+            raise ValueError('checksum mismatch')
+        return self.strip_empty(json.loads(zlib.decompress(base64.b64decode(payload))))  # json and base64 errors are ValueErrors
+
     def pad_with_empty(self, preamble_arr):
         if len(preamble_arr)>PREAMBLE_PARTS_COUNT:
             raise ValueError(f'There are too many parts in the preamble! Max is {PREAMBLE_PARTS_COUNT}, current is {len(preamble_arr)}')
@@ -68,62 +158,61 @@ class PreambleManager:
         return self.pad_with_empty(self.strip_empty(preamble_arr))
 
     def set_list(self, user_id, preamble_arr):
-        preamble_arr = self.shift_all_to_start(preamble_arr)
-        old_preamble = self.get_as_list(user_id, init_if_empty=False)
-        for key, old, new in zip(self.keys, old_preamble, preamble_arr):
-            if old!=new:
-                self.api.storage.set(user_id=user_id, key=key, value=new)
+        preamble_arr = self.strip_empty(preamble_arr)
+        if len(preamble_arr)>PREAMBLE_PARTS_COUNT:
+            raise ValueError(f'There are too many parts in the preamble! Max is {PREAMBLE_PARTS_COUNT}, current is {len(preamble_arr)}')
+        meta, chunks = self.pack(preamble_arr)
+        # chunks first, meta last: a reader racing us sees a checksum mismatch rather than a mix of old and new lines
+        values = dict(zip(self.chunk_keys, chunks))
+        values[self.meta_key] = meta
+        write_storage(self.api, user_id, values, self.batch)
 
     def delete(self, user_id, index):
-        arr = self.get_as_list(user_id)
-        arr.remove(index)
+        arr = self.get_as_list(user_id, for_update=True)
+        arr.pop(index)
         self.set_list(user_id, arr)
     
     def insert(self, user_id, new_line):
-        arr = self.strip_empty(self.get_as_list())
+        arr = self.strip_empty(self.get_as_list(user_id, for_update=True))
         arr.append(new_line)
         self.set_list(user_id, arr)
         return len(arr)-1 # index of new-added element
 
 class UserOptsManager:
-    def __init__(self, api):
+    KEYS = ['dpi', 'code_in_caption', 'time_in_caption']
+    def __init__(self, api, batch=None):
         self.api = api
+        self.batch = batch
+        self.profile = UserProfile(api)
+
+    def set(self, user_id, key, value):
+        write_storage(self.api, user_id, {key: value}, self.batch)
 
     def get_dpi(self, user_id):
-        return int(self.api.storage.get(key='dpi', user_id=user_id) or 300)
+        return int(self.profile.get(user_id).get('dpi') or 300)
 
     def set_dpi(self, user_id, value):
-        self.api.storage.set(key='dpi', user_id=user_id, value=value)
+        self.set(user_id, 'dpi', value)
 
     def get_code_in_caption(self, user_id):
-        return bool(self.api.storage.get(user_id=user_id, key='code_in_caption'))
+        return bool(self.profile.get(user_id).get('code_in_caption'))
     
     def set_code_in_caption(self, user_id, value):
-        if value:
-            self.api.storage.set(key='code_in_caption', value='True', user_id=user_id)
-        else:
-            self.api.storage.set(key='code_in_caption', value='', user_id=user_id)
+        self.set(user_id, 'code_in_caption', 'True' if value else '')
 
     def get_time_in_caption(self, user_id):
-        return bool(self.api.storage.get(user_id=user_id, key='time_in_caption'))
+        return bool(self.profile.get(user_id).get('time_in_caption'))
     
     def set_time_in_caption(self, user_id, value):
-        if value:
-            self.api.storage.set(key='time_in_caption', value='True', user_id=user_id)
-        else:
-            self.api.storage.set(key='time_in_caption', value='', user_id=user_id)
-
-    def get_last_render_time(self, user_id):
-        return int(self.api.storage.get(key='last_render_time', user_id=user_id) or 0)
-
-    def set_last_render_time(self, user_id, val):
-        self.api.storage.set(key='last_render_time', user_id=user_id, value=int(val))
+        self.set(user_id, 'time_in_caption', 'True' if value else '')
 
 class SecretProtectedPropertyStore:
     PROPERTY = 'seeecret',
     BOOLEAN = False
-    def __init__(self, api):
+    def __init__(self, api, batch=None):
         self.api = api
+        self.batch = batch
+        self.profile = UserProfile(api)
 
     def get_storage_key(self, user_id):
         if user_id % 2 == 0: # no particular reason, but more unpredictability is better
@@ -134,10 +223,11 @@ class SecretProtectedPropertyStore:
         return self.PROPERTY+'-'+digest
 
     def __getitem__(self, user_id):
+        value = self.profile.get(user_id).get(self.get_storage_key(user_id), '')
         if self.BOOLEAN:
-            return bool(self.api.storage.get(key=self.get_storage_key(user_id), user_id=user_id))
+            return bool(value)
         else:
-            return self.api.storage.get(key=self.get_storage_key(user_id), user_id=user_id)
+            return value
 
     def __setitem__(self, user_id, value):
         if self.BOOLEAN:
@@ -145,7 +235,7 @@ class SecretProtectedPropertyStore:
                 value = hmac.new(HMAC_SECRET, bytes( str(uuid.uuid4()), 'utf-8' ), 'sha1').hexdigest() # again, no reason, just make it look mysterious
             else:
                 value = ''
-        self.api.storage.set(user_id=user_id, key=self.get_storage_key(user_id), value=value)
+        write_storage(self.api, user_id, {self.get_storage_key(user_id): value}, self.batch)
 
 class ManagerStore(SecretProtectedPropertyStore):
     PROPERTY = 'manager'
@@ -155,6 +245,40 @@ class DisabledRateLimitStore(SecretProtectedPropertyStore):
     PROPERTY = 'disableRateLimit'
     BOOLEAN = True
 
+PROFILE_SECRET_STORES = [ManagerStore, DisabledRateLimitStore]
+
+class UserProfile:
+    '''
+    Everything the bot keeps about a user in VK storage, fetched with a single storage.get.
+
+    The result is cached in the LocalStore, so all web and renderer processes share it for PROFILE_TTL seconds.
+    Anything that writes one of these keys must call invalidate() afterwards.
+    '''
+    store = LocalStore()
+    def __init__(self, api):
+        self.api = api
+
+    def keys(self, user_id):
+        keys = UserOptsManager.KEYS + PreambleManager(self.api).keys
+        for store in PROFILE_SECRET_STORES:
+            keys.append(store(self.api).get_storage_key(user_id))
+        return keys
+
+    def cache_key(self, user_id):
+        return f'profile:{user_id}'
+
+    def get(self, user_id):
+        '''Return a dict of storage key to value; missing keys are empty strings, like VK returns them.'''
+        profile = self.store.get(self.cache_key(user_id))
+        if profile is None:
+            data = self.api.storage.get(keys=','.join(self.keys(user_id)), user_id=user_id)
+            profile = {element['key']: element['value'] for element in data}
+            self.store.set(self.cache_key(user_id), profile, ttl=PROFILE_TTL)
+        return profile
+
+    def invalidate(self, user_id):
+        self.store.delete(self.cache_key(user_id))
+
 class SignedValuePropertyStore:
     PROPERTY = 'seecret'
     DEFAULT_ON_HMAC_FAIL = None
@@ -0,0 +1,92 @@
+from playhouse.pool import PooledMySQLDatabase, MaxConnectionsExceeded
+from local_store import LocalStore
+import threading
+import time
+import os
+
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 2))  # connections per process; every process of every service counts against MariaDB's max_connections
+DB_POOL_STALE_TIMEOUT = int(os.getenv('DB_POOL_STALE_TIMEOUT', 300))  # age in seconds, counted from when it was opened, after which a connection is reopened rather than reused
+DB_POOL_WAIT_TIMEOUT = int(os.getenv('DB_POOL_WAIT_TIMEOUT', 10))  # seconds to wait for a free connection before giving up
+
+process_check_lock = threading.Lock()
+
+class PooledDatabase(PooledMySQLDatabase):
+    '''
+    MySQL database with a bounded connection pool per process.
+
+    Connections are pinged before reuse, and reopened once the stale timeout has passed since they were opened
+    (peewee counts it from when the connection was made, not from when it was last used).
+    When the pool is exhausted, connect() waits up to the wait timeout and then raises MaxConnectionsExceeded.
+    Forked children start with an empty pool instead of sharing the parent's sockets.
+    Waits and timeouts are counted in the LocalStore, so they add up over all processes on the host.
+    '''
+
+    store = LocalStore()
+    def __init__(self, database, max_connections=DB_POOL_SIZE, stale_timeout=DB_POOL_STALE_TIMEOUT, timeout=DB_POOL_WAIT_TIMEOUT, **kwargs):
+        self._pid = os.getpid()
+        super().__init__(database, max_connections=max_connections, stale_timeout=stale_timeout, timeout=timeout, **kwargs)
+        self.checkouts = 0
+        self.opened = 0
+
+    def ensure_process_state(self):
+        # after a fork the pool still lists the parent's sockets; closing them here would break its connections, so just drop them
+        if self._pid == os.getpid():
+            return
+        with process_check_lock:
+            if self._pid == os.getpid():
+                return
+            self._lock = threading.Lock()
+            self._pool_lock = threading.RLock()
+            self._connections = []
+            self._in_use = {}
+            self._state.reset()
+            self.checkouts = 0
+            self.opened = 0
+            self._pid = os.getpid()
+
+    def is_closed(self):
+        # peewee checks this before every query, so a forked child never gets to use the parent's connection
+        self.ensure_process_state()
+        return super().is_closed()
+
+    def close(self):
+        self.ensure_process_state()
+        return super().close()
+
+    def connect(self, reuse_if_open=False):
+        self.ensure_process_state()
+        t1 = time.time()
+        try:
+            result = super().connect(reuse_if_open)
+        except MaxConnectionsExceeded:
+            self.store.incr('db_pool.timeouts')
+            raise
+        waited = time.time()-t1
+        self.checkouts += 1
+        if waited > 0.1:  # the pool retries every 0.1 seconds, so anything longer means it was exhausted
+            self.store.incr('db_pool.waits')
+            self.store.incr('db_pool.wait_seconds', waited)
+        return result
+
+    def _connect(self):
+        with self._pool_lock:
+            idle = {self.conn_key(conn) for _, _, conn in self._connections}
+            conn = super()._connect()
+            if self.conn_key(conn) not in idle:
+                self.opened += 1
+            return conn
+
+    def stats(self):
+        '''This process's pool usage, plus the waits and timeouts of all processes on the host.'''
+        self.ensure_process_state()
+        shared = self.store.counters('db_pool.')
+        return {
+            'size': self._max_connections,
+            'in_use': len(self._in_use),
+            'idle': len(self._connections),
+            'checkouts': self.checkouts,
+            'opened': self.opened,
+            'waits': int(shared.get('db_pool.waits', 0)),
+            'wait_seconds': shared.get('db_pool.wait_seconds', 0),
+            'timeouts': int(shared.get('db_pool.timeouts', 0)),
+        }
@@ -0,0 +1,20 @@
+from latex_celery_tasks import cel
+from local_store import LocalStore
+import metrics
+import time
+
+store = LocalStore()
+
+@cel.task(acks_late=True)  # acknowledged only once handled, so an event survives a worker crash
+def process_event(data, received):
+    '''Handle a Callback API event that the web app has already acknowledged to VK.'''
+    import main  # main enqueues this task, so it is only imported once the task runs
+    started = time.time()
+    try:
+        main.handle_event(data)
+    finally:
+        store.incr('events.processed')
+        store.incr('events.queue_seconds', started-received)
+        store.incr('events.process_seconds', time.time()-started)
+        metrics.event_process_seconds.labels('queue_wait').observe(started-received)
+        metrics.event_process_seconds.labels('process').observe(time.time()-started)
@@ -0,0 +1,12 @@
+# read by gunicorn from the working directory; keeps the Prometheus samples of the worker processes consistent
+import metrics
+import shutil
+import os
+
+def on_starting(server):
+    # samples left by a previous run of this container would be added to the new ones
+    shutil.rmtree(metrics.PROMETHEUS_MULTIPROC_DIR, ignore_errors=True)
+    os.makedirs(metrics.PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+
+def child_exit(server, worker):
+    metrics.process_exited(worker.pid)
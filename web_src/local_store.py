@@ -0,0 +1,120 @@
+import threading
+import sqlite3
+import json
+import time
+import os
+
+LOCAL_STORE_PATH = os.getenv('LOCAL_STORE_PATH', '/cache/local_store.sqlite3')
+
+class LocalStore:
+    '''
+    Tiny key-value store with expiry and counters, kept in an SQLite file.
+
+    Every process that mounts the same file (gunicorn workers, celery workers) sees the same data,
+    so this is the place for state that must be shared on this host but is not worth a VK API call or a MariaDB round-trip.
+    '''
+
+    def __init__(self, path=LOCAL_STORE_PATH):
+        self.path = path
+        self.local = threading.local()
+
+    @property
+    def db(self):
+        # connections must not cross a fork (celery prefork, gunicorn), so keep one per thread per process
+        if getattr(self.local, 'pid', None) != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT, expires REAL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value REAL NOT NULL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS lru (namespace TEXT, key TEXT, value TEXT, expires REAL, used REAL, PRIMARY KEY (namespace, key))')
+            conn.execute('CREATE INDEX IF NOT EXISTS lru_used ON lru (namespace, used)')
+            conn.execute('CREATE TABLE IF NOT EXISTS seen (key TEXT PRIMARY KEY, expires REAL NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS seen_expires ON seen (expires)')
+            conn.execute('CREATE TABLE IF NOT EXISTS rate_buckets (user_id INTEGER PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS sched_pending (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, role TEXT, lane TEXT, task TEXT, args TEXT, enqueued REAL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS sched_pending_lane ON sched_pending (lane, user_id, id)')
+            conn.execute('CREATE TABLE IF NOT EXISTS sched_running (id INTEGER PRIMARY KEY, user_id INTEGER, role TEXT, lane TEXT, dispatched REAL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS sched_cursor (lane TEXT PRIMARY KEY, user_id INTEGER)')
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return self.local.conn
+
+    def get(self, key, default=None):
+        row = self.db.execute('SELECT value, expires FROM kv WHERE key=?', (key,)).fetchone()
+        if row is None:
+            return default
+        value, expires = row
+        if expires is not None and expires < time.time():
+            self.delete(key)
+            return default
+        return json.loads(value)
+
+    def set(self, key, value, ttl=None):
+        expires = time.time()+ttl if ttl is not None else None
+        self.db.execute('INSERT OR REPLACE INTO kv (key, value, expires) VALUES (?, ?, ?)', (key, json.dumps(value), expires))
+
+    def delete(self, key):
+        self.db.execute('DELETE FROM kv WHERE key=?', (key,))
+
+    def incr(self, name, by=1):
+        self.db.execute('INSERT INTO counters (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value=value+excluded.value', (name, by))
+
+    def counters(self, prefix=''):
+        rows = self.db.execute('SELECT name, value FROM counters WHERE substr(name, 1, ?)=?', (len(prefix), prefix))
+        return dict(rows)
+
+    def lru_get_many(self, namespace, keys):
+        '''Return a dict with the unexpired entries among these keys, marking them as recently used.'''
+        keys = [str(i) for i in keys]
+        found = {}
+        now = time.time()
+        for start in range(0, len(keys), 500):  # stay below SQLite's limit on query parameters
+            chunk = keys[start:start+500]
+            marks = ','.join('?'*len(chunk))
+            rows = self.db.execute(f'SELECT key, value FROM lru WHERE namespace=? AND key IN ({marks}) AND expires>=?', [namespace]+chunk+[now])
+            found.update((key, json.loads(value)) for key, value in rows)
+            self.db.execute(f'UPDATE lru SET used=? WHERE namespace=? AND key IN ({marks})', [now, namespace]+chunk)
+        return found
+
+    def lru_set_many(self, namespace, mapping, ttl, max_entries):
+        '''Store these entries, then drop the least recently used ones beyond max_entries in this namespace.'''
+        now = time.time()
+        db = self.db
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.executemany('INSERT OR REPLACE INTO lru (namespace, key, value, expires, used) VALUES (?, ?, ?, ?, ?)',
+                           [(namespace, str(key), json.dumps(value), now+ttl, now) for key, value in mapping.items()])
+            db.execute('DELETE FROM lru WHERE namespace=? AND key IN (SELECT key FROM lru WHERE namespace=? ORDER BY used DESC LIMIT -1 OFFSET ?)',
+                       (namespace, namespace, max_entries))
+            db.execute('COMMIT')
+        except:
+            db.execute('ROLLBACK')
+            raise
+
+    def mark_seen(self, keys, ttl, max_entries):
+        '''
+        Atomically record these keys as seen for ttl seconds. Returns False if any of them was already seen (and records nothing).
+        Expired keys are dropped, and so are the oldest ones beyond max_entries.
+        '''
+        now = time.time()
+        db = self.db
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.execute('DELETE FROM seen WHERE expires<?', (now,))
+            marks = ','.join('?'*len(keys))
+            if db.execute(f'SELECT 1 FROM seen WHERE key IN ({marks})', keys).fetchone() is not None:
+                db.execute('COMMIT')
+                return False
+            db.executemany('INSERT INTO seen (key, expires) VALUES (?, ?)', [(key, now+ttl) for key in keys])
+            db.execute('DELETE FROM seen WHERE key IN (SELECT key FROM seen ORDER BY expires DESC LIMIT -1 OFFSET ?)', (max_entries,))
+            db.execute('COMMIT')
+            return True
+        except:
+            db.execute('ROLLBACK')
+            raise
+
+    def forget_seen(self, keys):
+        marks = ','.join('?'*len(keys))
+        self.db.execute(f'DELETE FROM seen WHERE key IN ({marks})', keys)
@@ -0,0 +1,64 @@
+import contextlib
+import time
+import os
+
+# prometheus_client reads this when it is imported; every process of a service writes its samples there
+PROMETHEUS_MULTIPROC_DIR = os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', '/tmp/prometheus')
+os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+
+from prometheus_client import Counter, Histogram, CollectorRegistry, generate_latest, start_http_server, CONTENT_TYPE_LATEST
+from prometheus_client import multiprocess
+
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9100))  # where renderer containers serve /metrics
+BYTE_BUCKETS = tuple(2**i for i in range(10, 25))  # 1 KiB to 16 MiB
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+render_stage_seconds = Histogram('latexbot_render_stage_seconds', 'Time spent in each stage of a render', ['stage', 'lane'], buckets=STAGE_BUCKETS)
+renders_total = Counter('latexbot_renders_total', 'Finished renders', ['lane', 'outcome'])
+callback_ack_seconds = Histogram('latexbot_callback_ack_seconds', 'Time from receiving a VK callback to answering it', buckets=STAGE_BUCKETS)
+callback_events_total = Counter('latexbot_callback_events_total', 'VK callback events by how they were handled', ['type', 'handling'])
+event_process_seconds = Histogram('latexbot_event_process_seconds', 'Time the events workers took to handle an event', ['phase'], buckets=STAGE_BUCKETS)
+png_bytes = Histogram('latexbot_png_bytes', 'Size of rendered PNGs as Ghostscript wrote them and as sent', ['stage'], buckets=BYTE_BUCKETS)
+png_encodings_total = Counter('latexbot_png_encodings_total', 'Rendered PNGs by the form they were sent in', ['mode'])
+
+class StageTimer:
+    '''
+    Collects how long each named stage of one render took, in seconds.
+
+    Use "with timer.stage('name'):" around a stage; a stage entered twice adds up. Times measured elsewhere,
+    such as queue waits computed from timestamps, can be added with record().
+    '''
+
+    def __init__(self, stages=None):
+        self.stages = dict(stages or {})
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        t1 = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, time.time()-t1)
+
+    def record(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0) + seconds
+
+    def observe(self, lane):
+        for name, seconds in self.stages.items():
+            render_stage_seconds.labels(name, lane).observe(seconds)
+
+def registry():
+    collector = CollectorRegistry()
+    multiprocess.MultiProcessCollector(collector)
+    return collector
+
+def render_latest():
+    '''All metrics of every process of this service, in the Prometheus text format.'''
+    return generate_latest(registry()), CONTENT_TYPE_LATEST
+
+def serve(port=METRICS_PORT):
+    '''Serve /metrics from a background thread, for processes that have no web server of their own.'''
+    start_http_server(port, registry=registry())
+
+def process_exited(pid):
+    multiprocess.mark_process_dead(pid)
@@ -0,0 +1,45 @@
+from local_store import LocalStore
+import time
+import os
+
+def parse_limit(spec):
+    capacity, interval = spec.split(':')
+    return int(capacity), float(interval)
+
+# "burst:seconds" -- how many renders can be requested back to back, and how many seconds it takes to earn one more
+RATE_LIMITS = {
+    'user': parse_limit(os.getenv('RATE_LIMIT_USER', '1:30')),
+    'manager': parse_limit(os.getenv('RATE_LIMIT_MANAGER', '3:10')),
+}
+
+class RateLimiter:
+    '''
+    Token bucket per user, kept in the LocalStore's SQLite file so all gunicorn workers share it
+    and it survives restarts. Deciding costs one local transaction and no VK calls.
+    '''
+
+    def __init__(self, store=None, limits=RATE_LIMITS):
+        self.store = store or LocalStore()
+        self.limits = limits
+
+    def acquire(self, user_id, role='user'):
+        '''Take a token for this user. Returns (allowed, seconds until the next token is available).'''
+        capacity, interval = self.limits[role]
+        now = time.time()
+        db = self.store.db
+        db.execute('BEGIN IMMEDIATE')  # read-modify-write must not interleave with other workers
+        try:
+            row = db.execute('SELECT tokens, updated FROM rate_buckets WHERE user_id=?', (user_id,)).fetchone()
+            if row is None:
+                tokens = capacity
+            else:
+                tokens = min(capacity, row[0] + (now-row[1])/interval)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            db.execute('INSERT OR REPLACE INTO rate_buckets (user_id, tokens, updated) VALUES (?, ?, ?)', (user_id, tokens, now))
+            db.execute('COMMIT')
+        except:
+            db.execute('ROLLBACK')
+            raise
+        return allowed, 0 if allowed else (1-tokens)*interval
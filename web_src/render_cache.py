@@ -0,0 +1,111 @@
+from local_store import LocalStore
+import hashlib
+import uuid
+import json
+import os
+
+RENDER_CACHE_DIR = os.getenv('RENDER_CACHE_DIR', '/cache/renders')
+RENDER_CACHE_MAX_BYTES = int(os.getenv('RENDER_CACHE_MAX_BYTES', 256*1024*1024))
+
+IMAGE_FILE = 'image_%d.png'
+DOCUMENT_FILE = 'document.pdf'
+
+class RenderCache:
+    '''
+    Content-addressed store of finished renders, keyed on everything that affects the output.
+
+    Each entry is a directory holding one PNG per expression and, if a private render produced it, the cropped PDF.
+    Only successful renders are ever stored, so a failed compile is always retried.
+    Entries are evicted least-recently-used first once the total size goes over the cap.
+    '''
+
+    def __init__(self, directory=RENDER_CACHE_DIR, max_bytes=RENDER_CACHE_MAX_BYTES, store=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.store = store or LocalStore()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def key_for(self, preamble, expression, dpi, encoding=''):
+        '''encoding names the settings the PNGs are re-encoded with, so changing them does not serve old encodings.'''
+        return hashlib.sha256(bytes(json.dumps([preamble, expression, dpi, encoding]), 'utf-8')).hexdigest()
+
+    def get(self, key, with_pdf=False, record_stats=True):
+        '''Return (list of png, pdf) bytes for this key, or None on miss. pdf is None unless asked for.'''
+        entry = os.path.join(self.directory, key)
+        try:
+            with open(os.path.join(entry, 'count'), 'r') as f:
+                count = int(f.read())
+            pngs = []
+            for i in range(count):
+                with open(os.path.join(entry, IMAGE_FILE%i), 'rb') as f:
+                    pngs.append(f.read())
+            pdf = None
+            if with_pdf:
+                with open(os.path.join(entry, DOCUMENT_FILE), 'rb') as f:
+                    pdf = f.read()
+            os.utime(entry)  # mark as recently used
+        except FileNotFoundError:
+            if record_stats:
+                self.store.incr('render_cache.misses')
+            return None
+        if record_stats:
+            self.store.incr('render_cache.hits')
+        return pngs, pdf
+
+    def put(self, key, pngs, pdf=None):
+        entry = os.path.join(self.directory, key)
+        os.makedirs(entry, exist_ok=True)
+        files = [(IMAGE_FILE%i, png) for i, png in enumerate(pngs)]
+        if pdf is not None:
+            files.append((DOCUMENT_FILE, pdf))
+        files.append(('count', bytes(str(len(pngs)), 'ascii')))  # written last: the entry is complete once this exists
+        for name, data in files:
+            tmp = os.path.join(entry, name+'.'+uuid.uuid4().hex)  # readers must never see a half-written file
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, os.path.join(entry, name))
+        self.evict()
+
+    def entries(self):
+        '''List (last used, size, key) of every entry.'''
+        out = []
+        for entry in os.scandir(self.directory):
+            if not entry.is_dir():
+                continue
+            try:
+                size = sum(f.stat().st_size for f in os.scandir(entry.path))
+                out.append((entry.stat().st_mtime, size, entry.name))
+            except FileNotFoundError:  # evicted while we were looking
+                pass
+        return out
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            entry = os.path.join(self.directory, key)
+            try:
+                for f in os.scandir(entry):
+                    os.remove(f.path)
+                os.rmdir(entry)
+            except OSError:  # another process is evicting or writing it
+                pass
+            total -= size
+            self.store.incr('render_cache.evictions')
+
+    def stats(self):
+        counters = self.store.counters('render_cache.')
+        hits = int(counters.get('render_cache.hits', 0))
+        misses = int(counters.get('render_cache.misses', 0))
+        entries = self.entries()
+        return {
+            'hits': hits,
+            'misses': misses,
+            'evictions': int(counters.get('render_cache.evictions', 0)),
+            'hit_rate': hits/(hits+misses) if hits+misses else 0,
+            'entries': len(entries),
+            'bytes': sum(size for _, size, _ in entries),
+            'max_bytes': self.max_bytes,
+        }
@@ -0,0 +1,119 @@
+from local_store import LocalStore
+import json
+import time
+import os
+
+# lanes are Celery queues; which workers consume which lanes is set in docker-compose.yml
+LANES = ['render.manager', 'render.private', 'render.group', 'render.heavy']
+HEAVY_COST = float(os.getenv('SCHED_HEAVY_COST', 5))  # renders estimated to take longer than this many seconds go to the heavy lane
+USER_CAPS = {
+    'user': int(os.getenv('SCHED_USER_CAP', 1)),  # renders a user may have queued or running at once; the rest wait here
+    'manager': int(os.getenv('SCHED_MANAGER_CAP', 3)),
+}
+RUNNING_TIMEOUT = int(os.getenv('SCHED_RUNNING_TIMEOUT', 600))  # a render not released after this long is assumed lost
+
+def choose_lane(role, private, cost):
+    '''Pick the lane for a render, given its estimated cost in seconds (see cost_model).'''
+    if role == 'manager':
+        return 'render.manager'
+    if cost > HEAVY_COST:
+        return 'render.heavy'
+    return 'render.private' if private else 'render.group'
+
+class RenderScheduler:
+    '''
+    Holds render tasks in the LocalStore and releases them to their lane's Celery queue fairly.
+
+    Each user has at most their cap of renders in the broker or running; further submissions wait here.
+    Whenever a render finishes, the next waiting render is picked round-robin over the users with
+    renders waiting in that lane, so one user's backlog cannot get ahead of everyone else's.
+    The render task must call release() when it finishes, and record_wait() when it starts.
+    '''
+
+    def __init__(self, app, store=None, caps=USER_CAPS, running_timeout=RUNNING_TIMEOUT):
+        self.app = app
+        self.store = store or LocalStore()
+        self.caps = caps
+        self.running_timeout = running_timeout
+
+    def submit(self, user_id, role, lane, task, args):
+        '''Queue a render task (a task name and its positional arguments) for this user in this lane.'''
+        db = self.store.db
+        db.execute('INSERT INTO sched_pending (user_id, role, lane, task, args, enqueued) VALUES (?, ?, ?, ?, ?, ?)',
+                   (user_id, role, lane, task, json.dumps(args), time.time()))
+        self.dispatch()
+
+    def release(self, schedule_id):
+        '''Mark a dispatched render as finished and let the next ones through.'''
+        self.store.db.execute('DELETE FROM sched_running WHERE id=?', (schedule_id,))
+        self.dispatch()
+
+    def pick(self, db, lane):
+        '''Return the oldest pending row of the next user in round-robin order who is under their cap, or None.'''
+        cursor = db.execute('SELECT user_id FROM sched_cursor WHERE lane=?', (lane,)).fetchone()
+        cursor = cursor[0] if cursor else -1
+        users = [i[0] for i in db.execute('SELECT DISTINCT user_id FROM sched_pending WHERE lane=? ORDER BY user_id', (lane,))]
+        users = [i for i in users if i > cursor] + [i for i in users if i <= cursor]  # start right after the last user served
+        for user_id in users:
+            row = db.execute('SELECT id, role, task, args, enqueued FROM sched_pending WHERE lane=? AND user_id=? ORDER BY id LIMIT 1', (lane, user_id)).fetchone()
+            running = db.execute('SELECT COUNT(*) FROM sched_running WHERE user_id=?', (user_id,)).fetchone()[0]
+            if running < self.caps[row[1]]:
+                return (user_id,)+row
+        return None
+
+    def dispatch(self):
+        '''Send every render that is now allowed to run to its lane.'''
+        db = self.store.db
+        ready = []
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.execute('DELETE FROM sched_running WHERE dispatched<?', (time.time()-self.running_timeout,))
+            for lane in LANES:
+                while True:
+                    row = self.pick(db, lane)
+                    if row is None:
+                        break
+                    user_id, schedule_id, role, task, args, enqueued = row
+                    db.execute('DELETE FROM sched_pending WHERE id=?', (schedule_id,))
+                    db.execute('INSERT INTO sched_running (id, user_id, role, lane, dispatched) VALUES (?, ?, ?, ?, ?)', (schedule_id, user_id, role, lane, time.time()))
+                    db.execute('INSERT OR REPLACE INTO sched_cursor (lane, user_id) VALUES (?, ?)', (lane, user_id))
+                    ready.append((lane, task, json.loads(args), {'schedule': {'id': schedule_id, 'lane': lane, 'enqueued': enqueued}}))
+            db.execute('COMMIT')
+        except:
+            db.execute('ROLLBACK')
+            raise
+        for index, (lane, task, args, kwargs) in enumerate(ready):
+            try:
+                self.app.send_task(task, args, kwargs, queue=lane)
+            except:
+                self.requeue(ready[index:])  # the broker never got these, so they must wait here again
+                raise
+
+    def requeue(self, unsent):
+        db = self.store.db
+        for lane, task, args, kwargs in unsent:
+            schedule = kwargs['schedule']
+            user_id, role = db.execute('SELECT user_id, role FROM sched_running WHERE id=?', (schedule['id'],)).fetchone()
+            db.execute('DELETE FROM sched_running WHERE id=?', (schedule['id'],))
+            db.execute('INSERT INTO sched_pending (id, user_id, role, lane, task, args, enqueued) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                       (schedule['id'], user_id, role, lane, task, json.dumps(args), schedule['enqueued']))
+
+    def record_wait(self, schedule):
+        '''Count the time from submission until a worker started the render, per lane.'''
+        self.store.incr(f"sched.{schedule['lane']}.started")
+        self.store.incr(f"sched.{schedule['lane']}.wait_seconds", time.time()-schedule['enqueued'])
+
+    def stats(self):
+        '''Per lane: renders waiting here, renders dispatched and not finished, renders started and their mean queue wait.'''
+        db = self.store.db
+        counters = self.store.counters('sched.')
+        data = {}
+        for lane in LANES:
+            started = counters.get(f'sched.{lane}.started', 0)
+            data[lane] = {
+                'pending': db.execute('SELECT COUNT(*) FROM sched_pending WHERE lane=?', (lane,)).fetchone()[0],
+                'running': db.execute('SELECT COUNT(*) FROM sched_running WHERE lane=?', (lane,)).fetchone()[0],
+                'started': int(started),
+                'mean_wait': counters.get(f'sched.{lane}.wait_seconds', 0)/started if started else 0,
+            }
+        return data
@@ -1,9 +1,25 @@
 from peewee import *
+from playhouse.migrate import MySQLMigrator, migrate
+from collections import defaultdict
+from db_pool import PooledDatabase
+import threading
 import datetime
+import logging
+import json
+import atexit
 import uuid
 import os
 
-dbase = MySQLDatabase(os.getenv('MYSQL_DATABASE'), user='root', password=os.getenv('MYSQL_ROOT_PASSWORD'), host='database')
+STATS_FLUSH_SIZE = int(os.getenv('STATS_FLUSH_SIZE', 50))  # buffered render records that trigger a write
+STATS_FLUSH_INTERVAL = float(os.getenv('STATS_FLUSH_INTERVAL', 10))  # seconds a render record may wait in the buffer
+STATS_BUFFER_MAX = int(os.getenv('STATS_BUFFER_MAX', 10000))  # records kept while the database is unreachable; the oldest are dropped beyond this
+STATS_RETENTION_DAYS = int(os.getenv('STATS_RETENTION_DAYS', 7))
+STATS_ROLLUP_RETENTION_DAYS = int(os.getenv('STATS_ROLLUP_RETENTION_DAYS', 365))  # the per-day rollup is small, so it is kept much longer than the raw records
+STATS_TOP_DAYS = int(os.getenv('STATS_TOP_DAYS', 7))  # how many recent days the top-N reports cover
+STATS_PRUNE_BATCH = int(os.getenv('STATS_PRUNE_BATCH', 1000))  # rows deleted per statement when pruning, so no delete holds locks for long
+
+logger = logging.getLogger(__name__)
+dbase = PooledDatabase(os.getenv('MYSQL_DATABASE'), user='root', password=os.getenv('MYSQL_ROOT_PASSWORD'), host='database')
 
 class MyModel(Model):
     class Meta:
@@ -16,8 +32,47 @@ class User(MyModel):
 class Render(MyModel):
     user = ForeignKeyField(User)
     time_taken = FloatField()
-    when = DateTimeField(default=datetime.datetime.now)
+    when = DateTimeField(default=datetime.datetime.now, index=True)
     was_error = BooleanField(default=False)
+    stage_times = TextField(null=True)  # JSON object of stage name to seconds, see metrics.StageTimer
+
+    class Meta:
+        indexes = ((('user', 'was_error'), False),)
+
+# upper bounds in seconds of the render time histogram kept per rollup row; the last bucket takes everything slower
+TIME_BUCKETS = [0.25, 0.5, 1, 2, 4, 8, 16, 32, 64, 128]
+
+class RenderDaily(MyModel):
+    '''Per-user, per-day totals, updated whenever render records are written. The top-N reports read only this table.'''
+    user_id = IntegerField()
+    day = DateField(index=True)
+    renders = IntegerField(default=0)
+    errors = IntegerField(default=0)
+    total_time = FloatField(default=0)
+    histogram = CharField(default='')  # comma-separated counts of successful renders, one per TIME_BUCKETS entry plus the overflow bucket
+
+    class Meta:
+        primary_key = CompositeKey('user_id', 'day')
+
+def time_bucket(time_taken):
+    for index, bound in enumerate(TIME_BUCKETS):
+        if time_taken <= bound:
+            return index
+    return len(TIME_BUCKETS)
+
+def parse_histogram(histogram):
+    counts = [int(i) for i in histogram.split(',')] if histogram else []
+    return counts + [0]*(len(TIME_BUCKETS)+1-len(counts))
+
+def histogram_percentile(counts, fraction):
+    '''Estimate a percentile as the upper bound of the bucket it falls in.'''
+    target = fraction*sum(counts)
+    seen = 0
+    for index, count in enumerate(counts):
+        seen += count
+        if count and seen >= target:
+            return TIME_BUCKETS[index] if index < len(TIME_BUCKETS) else float('inf')
+    return 0
 
 class Error(MyModel):
     uuid = UUIDField(default=uuid.uuid4)
@@ -26,58 +81,233 @@ class Error(MyModel):
     caused_by_text = TextField(null=True)
     when = DateTimeField(default=datetime.datetime.now)
 
+class WorkerHeartbeat(MyModel):
+    hostname = CharField(primary_key=True)
+    queues = CharField(default='')
+    concurrency = IntegerField()
+    active = IntegerField()
+    processed = IntegerField()
+    last_seen = DateTimeField(default=datetime.datetime.now)
+
 def uses_dbase(fn):
     def wrapper(*args, **kwargs):
-        try:
-            dbase.connect()
-        except OperationalError: # may mean either failed connecting, or opening connection failed -- how to distinguish?
-            pass
+        checked_out = dbase.is_closed()  # nested calls reuse the connection the outer call took from the pool
+        if checked_out:
+            try:
+                dbase.connect()
+            except OperationalError: # may mean either failed connecting, or opening connection failed -- how to distinguish?
+                pass
         try:
             res = fn(*args, **kwargs)
             return res
         finally:
-            dbase.close()
+            if checked_out:
+                dbase.close()  # returns the connection to the pool
     return wrapper
 
+def add_missing_columns(model, *fields):
+    '''create_tables leaves existing tables alone, so columns added to a model later are added here.'''
+    existing = [column.name for column in dbase.get_columns(model._meta.table_name)]
+    migrator = MySQLMigrator(dbase)
+    migrate(*[migrator.add_column(model._meta.table_name, field.column_name, field) for field in fields if field.column_name not in existing])
+
+def add_missing_indexes(model):
+    '''Likewise for indexes added to a model later; an index counts as present if one exists on the same columns.'''
+    table = model._meta.table_name
+    existing = [tuple(index.columns) for index in dbase.get_indexes(table)]
+    migrator = MySQLMigrator(dbase)
+    wanted = []
+    for index in model._meta.fields_to_index():
+        columns = tuple(i.column_name for i in index._expressions)
+        if columns not in existing:
+            wanted.append(migrator.add_index(table, columns, index._unique))
+    migrate(*wanted)
+
 dbase.connect()
+backfill_rollup = not RenderDaily.table_exists()
 with dbase.atomic():
-    dbase.create_tables([User, Render, Error])
+    dbase.create_tables([User, Render, Error, WorkerHeartbeat, RenderDaily])
+add_missing_columns(WorkerHeartbeat, WorkerHeartbeat.queues)
+add_missing_columns(Render, Render.stage_times)
+add_missing_indexes(Render)
 dbase.close()
 
 @uses_dbase
-def delete_older_than(days=7, seconds=0):
+def delete_older_than(days=STATS_RETENTION_DAYS, seconds=0, batch_size=STATS_PRUNE_BATCH):
+    '''Delete old render records a batch at a time, each batch in its own transaction. Returns how many were deleted.'''
     delta = datetime.timedelta(days, seconds)
     cutoff_date = datetime.datetime.now() - delta
-    return Render.delete().where(Render.when < cutoff_date).execute()
+    deleted = 0
+    while True:
+        with dbase.atomic():
+            ids = [i.id for i in Render.select(Render.id).where(Render.when < cutoff_date).order_by(Render.id).limit(batch_size)]
+            if ids:
+                deleted += Render.delete().where(Render.id.in_(ids)).execute()
+        if len(ids) < batch_size:
+            return deleted
 
 @uses_dbase
-def get_top_by_time_taken(num=10):
-    query = User.select(User, fn.Sum(Render.time_taken).alias('total_time')).join(Render, JOIN.LEFT_OUTER).group_by(User).order_by(SQL('total_time').desc()).limit(num)
-    out_list = []
-    for user in query:
-        out_list.append( (user.user_id, user.total_time) )
-    return out_list
+def delete_old_rollups(days=STATS_ROLLUP_RETENTION_DAYS):
+    cutoff_day = datetime.date.today() - datetime.timedelta(days)
+    return RenderDaily.delete().where(RenderDaily.day < cutoff_day).execute()
+
+def top_query(column, num, days):
+    first_day = datetime.date.today() - datetime.timedelta(days-1)
+    return (RenderDaily.select(RenderDaily.user_id, fn.Sum(column).alias('total'))
+            .where(RenderDaily.day >= first_day).group_by(RenderDaily.user_id)
+            .having(fn.Sum(column) > 0).order_by(SQL('total').desc()).limit(num))
 
 @uses_dbase
-def get_top_by_errors(num=10):
-    query = User.select(User, fn.Count(Render.id).alias('errors')).join(Render).where(Render.was_error == True).group_by(User).order_by(SQL('errors').desc()).limit(num)
+def get_top_by_time_taken(num=10, days=STATS_TOP_DAYS):
+    '''Return (user id, total seconds, p95 seconds) for the users who took the most rendering time.'''
     out_list = []
-    for user in query:
-        out_list.append( (user.user_id, user.errors) )
+    top = {row.user_id: row.total for row in top_query(RenderDaily.total_time, num, days)}
+    histograms = defaultdict(lambda: [0]*(len(TIME_BUCKETS)+1))
+    first_day = datetime.date.today() - datetime.timedelta(days-1)
+    for row in RenderDaily.select().where(RenderDaily.user_id.in_(list(top)), RenderDaily.day >= first_day):
+        histograms[row.user_id] = [a+b for a, b in zip(histograms[row.user_id], parse_histogram(row.histogram))]
+    for user_id, total in top.items():
+        out_list.append( (user_id, total, histogram_percentile(histograms[user_id], 0.95)) )
     return out_list
 
 @uses_dbase
-def get_top_by_renders(num=10):
-    query = User.select(User, fn.Count(Render.id).alias('renders')).join(Render).group_by(User).order_by(SQL('renders').desc()).limit(num)
-    out_list = []
-    for user in query:
-        out_list.append( (user.user_id, user.renders) )
-    return out_list
+def get_mean_render_time(user_id=None, days=STATS_TOP_DAYS):
+    '''Mean seconds per successful render over the recent days, for one user or everyone; None without any.
+
+    Renders that failed before finishing are recorded with no time taken, so errors are left out of the count too;
+    otherwise they would drag the mean, and the cost estimates built on it, towards zero.
+    '''
+    first_day = datetime.date.today() - datetime.timedelta(days-1)
+    query = RenderDaily.select(fn.Sum(RenderDaily.total_time), fn.Sum(RenderDaily.renders - RenderDaily.errors)).where(RenderDaily.day >= first_day)
+    if user_id is not None:
+        query = query.where(RenderDaily.user_id == user_id)
+    total_time, successes = query.tuples().get()
+    return total_time/successes if successes else None
+
+@uses_dbase
+def get_top_by_errors(num=10, days=STATS_TOP_DAYS):
+    return [(row.user_id, int(row.total)) for row in top_query(RenderDaily.errors, num, days)]
 
 @uses_dbase
-def record_render(user_id, time_taken, error=False):
-    user = User.get_or_create(user_id=user_id)[0]
-    Render.create(user=user, time_taken=time_taken, was_error=error)
+def get_top_by_renders(num=10, days=STATS_TOP_DAYS):
+    return [(row.user_id, int(row.total)) for row in top_query(RenderDaily.renders, num, days)]
+
+buffer_setup_lock = threading.Lock()
+
+class RenderBuffer:
+    '''
+    Collects render records in memory and writes them with one bulk insert per table,
+    once STATS_FLUSH_SIZE records are waiting or the oldest has waited STATS_FLUSH_INTERVAL seconds.
+
+    Each process has its own buffer and flusher thread. Call flush() before the process exits
+    (celery's prefork children skip atexit handlers), or the records still buffered are lost.
+    If a write fails, the records stay buffered for the next attempt.
+    '''
+
+    def __init__(self, size=STATS_FLUSH_SIZE, interval=STATS_FLUSH_INTERVAL, max_records=STATS_BUFFER_MAX):
+        self.size = size
+        self.interval = interval
+        self.max_records = max_records
+        self.records = []
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self._pid = None
+        atexit.register(self.flush)
+
+    def ensure_flusher(self):
+        # the flusher thread does not survive a fork, so each process starts its own
+        if self._pid == os.getpid():
+            return
+        with buffer_setup_lock:  # threads of a threads-pool worker may all get here first at once
+            if self._pid == os.getpid():
+                return
+            if self._pid is not None:  # forked: the lock may be held by a parent thread, and the records are the parent's to write
+                self.lock = threading.Lock()
+                self.records = []
+            threading.Thread(target=self.flusher, daemon=True).start()
+            self._pid = os.getpid()  # last, so no thread appends before the buffer is ready
+
+    def flusher(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except:
+                logger.exception('Failed to write buffered render stats, will retry')
+
+    def add(self, user_id, time_taken, error=False, stage_times=None):
+        self.ensure_flusher()
+        with self.lock:
+            self.records.append({'user': user_id, 'time_taken': time_taken, 'was_error': error, 'when': datetime.datetime.now(),
+                                 'stage_times': json.dumps(stage_times) if stage_times else None})
+            if len(self.records) > self.max_records:
+                logger.warning('Render stats buffer is full, dropping %d oldest records', len(self.records)-self.max_records)
+                del self.records[:-self.max_records]
+            if len(self.records) >= self.size:
+                self.wakeup.set()
+
+    def flush(self):
+        with self.lock:
+            records, self.records = self.records, []
+        if not records:
+            return 0
+        try:
+            write_renders(records)
+        except:
+            with self.lock:
+                self.records[:0] = records
+            raise
+        return len(records)
+
+def add_to_rollup(records):
+    '''Fold render records into the per-day rollup. Must run inside the transaction that writes the records.'''
+    rollup = {}
+    for record in records:
+        key = (record['user'], record['when'].date())
+        if key not in rollup:
+            rollup[key] = {'user_id': key[0], 'day': key[1], 'renders': 0, 'errors': 0, 'total_time': 0, 'histogram': parse_histogram('')}
+        row = rollup[key]
+        row['renders'] += 1
+        row['errors'] += bool(record['was_error'])
+        row['total_time'] += record['time_taken']
+        if not record['was_error']:  # failures are recorded with no time taken and would pull the percentiles down
+            row['histogram'][time_bucket(record['time_taken'])] += 1
+    for key, row in sorted(rollup.items()):
+        # the histogram cannot be summed in SQL, so lock the existing row and merge here
+        existing = RenderDaily.select().where(RenderDaily.user_id == key[0], RenderDaily.day == key[1]).for_update().first()
+        if existing is not None:
+            row['renders'] += existing.renders
+            row['errors'] += existing.errors
+            row['total_time'] += existing.total_time
+            row['histogram'] = [a+b for a, b in zip(row['histogram'], parse_histogram(existing.histogram))]
+        row['histogram'] = ','.join(str(i) for i in row['histogram'])
+    RenderDaily.insert_many(list(rollup.values())).on_conflict_replace().execute()
+
+@uses_dbase
+def write_renders(records):
+    with dbase.atomic():
+        User.insert_many([{'user_id': i} for i in sorted({r['user'] for r in records})]).on_conflict_ignore().execute()
+        Render.insert_many(records).execute()
+        add_to_rollup(records)
+
+@uses_dbase
+def backfill_rollups():
+    '''Build the rollup from the render records still kept, for databases created before it existed.'''
+    with dbase.atomic():
+        RenderDaily.delete().execute()
+        records = [{'user': i.user_id, 'time_taken': i.time_taken, 'was_error': i.was_error, 'when': i.when} for i in Render.select()]
+        if records:
+            add_to_rollup(records)
+    return len(records)
+
+if backfill_rollup:
+    backfill_rollups()
+
+render_buffer = RenderBuffer()
+
+def record_render(user_id, time_taken, error=False, stage_times=None):
+    render_buffer.add(user_id, time_taken, error, stage_times)
 
 @uses_dbase
 def record_error(trace, user_id=None, text=None):
@@ -99,3 +329,20 @@ def delete_all_errors():
 @uses_dbase
 def list_latest_errors(how_many=10):
     return [i.uuid for i in Error.select().order_by(Error.when.desc()).limit(how_many)]
+
+@uses_dbase
+def record_heartbeat(hostname, queues, concurrency, active, processed):
+    WorkerHeartbeat.replace(hostname=hostname, queues=queues, concurrency=concurrency, active=active, processed=processed, last_seen=datetime.datetime.now()).execute()
+
+@uses_dbase
+def delete_heartbeat(hostname):
+    return WorkerHeartbeat.delete().where(WorkerHeartbeat.hostname == hostname).execute()
+
+@uses_dbase
+def list_workers(max_age=None):
+    '''Return dicts describing the workers that sent a heartbeat in the last max_age seconds (or ever).'''
+    query = WorkerHeartbeat.select().order_by(WorkerHeartbeat.hostname)
+    if max_age is not None:
+        query = query.where(WorkerHeartbeat.last_seen > datetime.datetime.now() - datetime.timedelta(seconds=max_age))
+    now = datetime.datetime.now()
+    return [{'hostname': i.hostname, 'queues': i.queues.split(','), 'concurrency': i.concurrency, 'active': i.active, 'processed': i.processed, 'age': (now - i.last_seen).total_seconds()} for i in query]
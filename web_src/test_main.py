@@ -0,0 +1,38 @@
+'''
+Tests for the web app. Importing main connects to the database, so they are meant to run inside the web image:
+
+    docker-compose run --rm --entrypoint python web -m unittest test_main
+'''
+from unittest import mock
+import unittest
+import main
+
+class ErrorLinkTest(unittest.TestCase):
+    '''ERROR must link to the same page whether it is called while answering a request or from the events worker.'''
+
+    def error_url(self):
+        with mock.patch.object(main.stats, 'record_error', return_value='some-uid'), \
+             mock.patch.object(main, 'vkapi') as vkapi:
+            url = main.ERROR('Traceback', 1, 'text')
+        self.assertIn(url, vkapi.messages.send.call_args.kwargs['message'])
+        return url
+
+    def test_in_request(self):
+        with main.app.test_request_context():
+            self.assertEqual(self.error_url(), main.SERVER_NAME+'/view-error/some-uid')
+
+    def test_outside_request(self):
+        # how handle_queued_event runs message handlers
+        with main.app.app_context():
+            self.assertEqual(self.error_url(), main.SERVER_NAME+'/view-error/some-uid')
+
+class WorkersViewTest(unittest.TestCase):
+    def test_marks_dead_workers(self):
+        workers = [{'hostname': 'celery@a', 'queues': ['render.private'], 'concurrency': 4, 'active': 1, 'processed': 10, 'age': 1},
+                   {'hostname': 'celery@b', 'queues': ['deliver'], 'concurrency': 16, 'active': 0, 'processed': 5, 'age': main.WORKER_MAX_AGE+1}]
+        with mock.patch.object(main.stats, 'list_workers', return_value=workers):
+            response = main.app.test_client().get('/workers')
+        self.assertEqual([worker['alive'] for worker in response.get_json()], [True, False])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,29 +1,210 @@
+from local_store import LocalStore
+import requests
+import threading
+import logging
+import vk_api
+import time
+import re
+import os
+
+USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', 86400))  # seconds a resolved screen name is trusted; users can rename themselves
+USER_CACHE_MAX_ENTRIES = int(os.getenv('USER_CACHE_MAX_ENTRIES', 10000))
+USERS_GET_MAX_IDS = 1000  # the most user_ids VK accepts in one users.get call
+VK_API_BASE_URL = os.getenv('VK_API_BASE_URL')  # set to send all VK API calls elsewhere, such as to loadtest/vk_emulator.py
+VK_API_RPS = float(os.getenv('VK_API_RPS', 20))  # VK API calls per second, per process; community tokens are allowed 20
+VK_API_URL = re.compile(r'^https://api\.vk\.(com|ru)/')
+
+class RequestPacer:
+    '''
+    Spaces out requests made from any thread of this process to at most rps a second.
+
+    Only the choice of a time slot is done under the lock; the wait and the request itself are not,
+    so requests from different threads are in flight at the same time.
+    '''
+    def __init__(self, rps):
+        self.interval = 1/rps if rps else 0
+        self.lock = threading.Lock()
+        self.next_slot = 0
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot+self.interval
+        if slot > now:
+            time.sleep(slot-now)
+
+pacer = RequestPacer(VK_API_RPS)
+
+class VKSession(requests.Session):
+    '''HTTP session for a VkApi: paces API calls process-wide and sends them to VK_API_BASE_URL if that is set.'''
+    def __init__(self, base_url=VK_API_BASE_URL):
+        super().__init__()
+        self.base_url = base_url.rstrip('/')+'/' if base_url else None
+        self.headers['User-agent'] = vk_api.vk_api.DEFAULT_USERAGENT
+
+    def request(self, method, url, *args, **kwargs):
+        if VK_API_URL.match(url):
+            pacer.wait()
+            if self.base_url:
+                url = VK_API_URL.sub(self.base_url, url)
+        return super().request(method, url, *args, **kwargs)
+
+class CommunityVkApi(vk_api.VkApi):
+    # vk_api sleeps between calls holding the instance lock, which serializes every thread using the instance
+    # and assumes the user-token limit of 3 calls a second; VKSession does the pacing instead
+    RPS_DELAY = 0
+
+def make_vk_session(token):
+    '''A VkApi for this community token.'''
+    return CommunityVkApi(token=token, session=VKSession())
+
+class ThreadLocalVkApi:
+    '''
+    Stands in for vk_session.get_api() in code called from many threads, such as the delivery pool.
+
+    A VkApi holds a lock for the whole duration of each call, so every thread (and every process after a fork)
+    gets a VkApi of its own here; all of them still share the process-wide pacing of VKSession.
+    '''
+    def __init__(self, token):
+        self.token = token
+        self.local = threading.local()
+
+    @property
+    def _vk(self):
+        if getattr(self.local, 'pid', None) != os.getpid():
+            self.local.session = make_vk_session(self.token)
+            self.local.pid = os.getpid()
+        return self.local.session
+
+    def __getattr__(self, name):
+        return getattr(self._vk.get_api(), name)
+
+class VKBatchError(Exception):
+    def __init__(self, failures):
+        self.failures = failures
+        super().__init__('; '.join(f'{method}: [{error.get("error_code")}] {error.get("error_msg")}' for method, values, error in failures))
+
+class VKBatch:
+    '''
+    Collects storage.set and messages.send calls and runs them as VK execute requests of up to 25 calls each.
+
+    Use as a context manager, or call execute() yourself. Every queued call returns a vk_api RequestResult,
+    which has .ok and .error once the batch ran. If a call queued with required=True fails, execute() raises
+    VKBatchError listing all such failures, after every other call has still been attempted.
+    '''
+    logger = logging.getLogger(__name__)
+    def __init__(self, api):
+        self.api = api
+        session = getattr(api, '_vk', api)  # the pool needs the VkApi, not the method proxy
+        self.pool = vk_api.VkRequestsPool(session)
+        self.calls = []
+        self.callbacks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
+
+    def add(self, method, values, required=True):
+        result = self.pool.method(method, values)
+        self.calls.append((method, values, required, result))
+        return result
+
+    def storage_set(self, required=True, **values):
+        return self.add('storage.set', values, required)
+
+    def messages_send(self, required=True, **values):
+        return self.add('messages.send', values, required)
+
+    def after(self, callback):
+        '''Run callback once the queued calls have been sent, e.g. to invalidate a cache.'''
+        self.callbacks.append(callback)
+
+    def execute(self):
+        calls, self.calls = self.calls, []
+        callbacks, self.callbacks = self.callbacks, []
+        try:
+            if calls:
+                self.pool.execute()  # splits into execute requests of 25 calls
+        finally:
+            for callback in callbacks:
+                callback()
+        failures = []
+        for method, values, required, result in calls:
+            if not result.ok:
+                self.logger.warning('Batched call %s failed: %s', method, result.error)
+                if required:
+                    failures.append((method, values, result.error))
+        if failures:
+            raise VKBatchError(failures)
+
 class VKUtilities:
+    '''
+    Converts between user ids and @-mentions.
+
+    Lookups go through an LRU cache with expiry in the LocalStore, shared by the web app and the renderers,
+    in both directions (id -> screen name, screen name -> id). Whatever is not cached is fetched
+    with as few users.get calls as possible, so resolving a whole top-N list costs one call.
+    '''
+    store = LocalStore()
     def __init__(self, api):
         self.api = api
 
+    def remember(self, users):
+        by_id = {user['id']: user.get('screen_name') for user in users}
+        by_name = {user['screen_name']: user['id'] for user in users if user.get('screen_name')}
+        self.store.lru_set_many('user_screen_name', by_id, USER_CACHE_TTL, USER_CACHE_MAX_ENTRIES)
+        if by_name:
+            self.store.lru_set_many('user_id', by_name, USER_CACHE_TTL, USER_CACHE_MAX_ENTRIES)
+
+    def fetch_users(self, user_ids):
+        '''Call users.get for these ids or screen names, as few times as possible, and cache the results.'''
+        users = []
+        for start in range(0, len(user_ids), USERS_GET_MAX_IDS):
+            chunk = user_ids[start:start+USERS_GET_MAX_IDS]
+            users.extend(self.api.users.get(user_ids=','.join(str(i) for i in chunk), fields='screen_name'))
+        if users:
+            self.remember(users)
+        return users
+
+    def get_screen_names(self, user_ids):
+        '''Return a dict of user id -> screen name (None if the user has none) for every id that exists.'''
+        user_ids = list(dict.fromkeys(int(i) for i in user_ids))
+        names = {int(k): v for k, v in self.store.lru_get_many('user_screen_name', user_ids).items()}
+        missing = [i for i in user_ids if i not in names]
+        if missing:
+            names.update((user['id'], user.get('screen_name')) for user in self.fetch_users(missing))
+        return names
+
+    def get_at_specs(self, user_ids):
+        '''Return a dict of user id -> @-mention, using at most one users.get call per thousand uncached ids.'''
+        user_ids = list(user_ids)
+        names = self.get_screen_names(user_ids)
+        return {int(i): '@'+names[int(i)] if names.get(int(i)) else f'@id{i}' for i in user_ids}
+
     def get_at_spec(self, user_id):
-        data = self.api.users.get(user_ids=user_id, fields='screen_name')[0]
-        try:
-            return '@'+data['screen_name']
-        except KeyError:
-            return f'@id{user_id}'
+        return self.get_at_specs([user_id])[int(user_id)]
 
     def resolve_to_user_id(self, at_spec):
         if at_spec.startswith('@'):
             try:
-                data = self.api.users.get(user_ids=at_spec[1:], fields='screen_name')[0]
-                return data['id']
+                screen_name = at_spec[1:]
+                cached = self.store.lru_get_many('user_id', [screen_name])
+                if screen_name in cached:
+                    return cached[screen_name]
+                return self.fetch_users([screen_name])[0]['id']
             except:
                 safe_str = at_spec.replace('@', '(at)').replace('[', '(lbrak)').replace(']','(rbrak)').replace('|', '(pipe)')
                 raise ValueError(f'Failed to resolve "{safe_str}" (which is a plain @-mention)')
         elif at_spec.startswith('['):
             try:
                 resolved = int(at_spec.split('id')[1].split('|')[0])
-                data = self.api.users.get(user_ids=resolved)
+                if resolved not in self.get_screen_names([resolved]):
+                    raise KeyError(resolved)
                 return resolved
             except:
                 safe_str = at_spec.replace('@', '(at)').replace('[', '(lbrak)').replace(']','(rbrak)').replace('|', '(pipe)')
                 raise ValueError(f'Failed to resolve "{safe_str}" (which is a link-style)')
-
-